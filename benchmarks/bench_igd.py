@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Times discovery and port mapping operations end to end against the in-process fake IGD in
+fake_igd.py, so the hot paths can be measured without a physical router:
+
+- SSDP.list: a full search, a search stopping at the first router, and a cached listing
+- get_port_mappings (what port list runs) on tables of 10, 1000 and 10000 entries
+- apply_router_port_mappings adding a batch of mappings
+
+Results can be written to a JSON file and compared against an earlier run to catch regressions.
+
+    $ python3 benchmarks/bench_igd.py [--sizes 10 1000 10000] [--adds 1000] [--latency-ms 0]
+          [--fault-rate 0] [--repeat 3] [--output igd.json] [--baseline igd.json] [--tolerance 0.2]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep the benchmark's router cache away from the user's
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='bench-igd-')
+
+from fake_igd import FakeIGD
+from ssdp import SSDP, FirstRouter
+from upnp import UPnp, PortMapping
+
+
+def best_of(repeat, setup, run):
+    """Returns the fastest of repeat runs in seconds, and the value of the last run."""
+    best = None
+    value = None
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        value = run(state)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, value
+
+
+def bench_discovery(args):
+    results = []
+    with FakeIGD(latency_secs=args.latency_ms / 1000) as igd:
+        SSDP.multicast_host, SSDP.multicast_port = igd.ssdp_address
+        SSDP.response_time_secs = args.response_window
+
+        scenarios = [
+            ('ssdp_list_full', lambda _: SSDP.list(refresh=True)),
+            ('ssdp_list_first_router', lambda _: SSDP.list(refresh=True, until=FirstRouter())),
+            ('ssdp_list_cached', lambda _: SSDP.list()),
+        ]
+        for name, run in scenarios:
+            elapsed, routers = best_of(args.repeat, lambda: None, run)
+            results.append(result(name, elapsed, routers=len(routers)))
+    return results
+
+
+def bench_listing(args):
+    results = []
+    for size in args.sizes:
+        with FakeIGD(entries=size, latency_secs=args.latency_ms / 1000, fault_rate=args.fault_rate) as igd:
+            router = describe(igd)
+
+            def setup():
+                igd.requests = 0
+
+            elapsed, portmaps = best_of(args.repeat, setup, lambda _: UPnp.get_port_mappings(router))
+            results.append(result('list_port_mappings_%d' % size, elapsed, entries=len(portmaps), requests=igd.requests))
+    return results
+
+
+def bench_adds(args):
+    changes = [
+        ('add', PortMapping(public_port=20000 + i, protocol='TCP', private_ip='192.168.1.50', private_port=20000 + i))
+        for i in range(args.adds)
+    ]
+
+    with FakeIGD(latency_secs=args.latency_ms / 1000, fault_rate=args.fault_rate) as igd:
+        router = describe(igd)
+
+        def setup():
+            igd.table.clear()
+            igd._index = None
+
+        elapsed, outcomes = best_of(args.repeat, setup, lambda _: UPnp.apply_router_port_mappings(router, changes))
+        failed = sum(1 for o in outcomes if not o.success)
+        return [result('add_port_mappings_%d' % args.adds, elapsed, added=len(outcomes) - failed, failed=failed)]
+
+
+def result(name, elapsed, **details):
+    return dict({'scenario': name, 'secs': elapsed}, **details)
+
+
+def describe(igd):
+    """Returns the Router for a fake IGD, described the way discovery would."""
+    from ssdp import Router
+
+    router = Router(
+        url=igd.location,
+        ip='127.0.0.1',
+        port=igd.ssdp_address[1],
+        wan_ip_type='urn:schemas-upnp-org:service:WANIPConnection:1',
+        base_url=igd.location.rsplit('/', 1)[0]
+    )
+    SSDP._describe_router(router, SSDP._fetch_description(router.url))
+    return router
+
+
+def compare(results, baseline_path, tolerance):
+    """Prints how each scenario changed since the baseline. Returns the scenarios that regressed."""
+    with open(baseline_path) as f:
+        baseline = {r['scenario']: r['secs'] for r in json.load(f)}
+
+    regressions = []
+    print()
+    template = "{0:30}{1:>14}{2:>14}{3:>10}"
+    print(template.format("SCENARIO", "BASELINE (ms)", "NOW (ms)", "CHANGE"))
+    for r in results:
+        before = baseline.get(r['scenario'])
+        if before is None:
+            continue
+        change = (r['secs'] - before) / before if before else 0
+        flag = ''
+        if change > tolerance:
+            regressions.append(r['scenario'])
+            flag = '  REGRESSION'
+        print(template.format(r['scenario'], '%.1f' % (before * 1000), '%.1f' % (r['secs'] * 1000), '%+.0f%%' % (change * 100)) + flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000], help='Port mapping table sizes to list.')
+    parser.add_argument('--adds', type=int, default=1000, help='Number of port mappings added in one batch.')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay the fake router adds to each SOAP action.')
+    parser.add_argument('--fault-rate', type=float, default=0, help='Fraction of SOAP actions failing with ActionFailed.')
+    parser.add_argument('--response-window', type=float, default=1, help='SSDP.response_time_secs used for discovery.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario, the fastest is reported.')
+    parser.add_argument('--output', help='Also write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare with the results of an earlier run written with --output.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Slowdown over the baseline reported as a regression.')
+    args = parser.parse_args()
+
+    results = bench_discovery(args)
+    results += bench_listing(args)
+    results += bench_adds(args)
+
+    template = "{0:30}{1:>12}  {2}"
+    print(template.format("SCENARIO", "TIME (ms)", "DETAILS"))
+    for r in results:
+        details = ', '.join('%s=%s' % (k, v) for k, v in r.items() if k not in ('scenario', 'secs'))
+        print(template.format(r['scenario'], '%.1f' % (r['secs'] * 1000), details))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
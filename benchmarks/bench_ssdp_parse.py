@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Compares extracting the headers of M-SEARCH responses through SSDPResponse.parse (email.parser)
+with the bytes-level parse_ssdp_headers fast path used by discovery.
+
+    $ python3 benchmarks/bench_ssdp_parse.py [--packets 500] [--repeat 5]
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ssdp import SSDPResponse, parse_ssdp_headers
+
+ROUTER_RESPONSE = (
+    'HTTP/1.1 200 OK\r\n'
+    'CACHE-CONTROL: max-age=120\r\n'
+    'DATE: Sat, 17 Oct 2026 10:00:00 GMT\r\n'
+    'EXT:\r\n'
+    'LOCATION: http://192.168.1.1:5000/rootDesc.xml\r\n'
+    'SERVER: Linux/5.4 UPnP/1.1 MiniUPnPd/2.2.1\r\n'
+    'ST: urn:schemas-upnp-org:service:WANIPConnection:1\r\n'
+    'USN: uuid:11111111-2222-3333-4444-{:012d}::urn:schemas-upnp-org:service:WANIPConnection:1\r\n'
+    'OPT: "http://schemas.upnp.org/upnp/1/0/"; ns=01\r\n'
+    '01-NLS: 1\r\n'
+    'BOOTID.UPNP.ORG: 1\r\n'
+    'CONFIGID.UPNP.ORG: 1337\r\n'
+    '\r\n'
+)
+
+MEDIA_RENDERER_RESPONSE = (
+    'HTTP/1.1 200 OK\r\n'
+    'Cache-Control: max-age=1800\r\n'
+    'Ext:\r\n'
+    'Location: http://192.168.1.{}:9197/dmr\r\n'
+    'Server: SHP, UPnP/1.0, Samsung UPnP SDK/1.0\r\n'
+    'St: urn:schemas-upnp-org:device:MediaRenderer:1\r\n'
+    'Usn: uuid:aaaaaaaa-bbbb-cccc-dddd-{:012d}::urn:schemas-upnp-org:device:MediaRenderer:1\r\n'
+    'Content-Length: 0\r\n'
+    '\r\n'
+)
+
+
+def make_packets(count):
+    packets = []
+    for i in range(count):
+        if i % 4 == 0:
+            packets.append(ROUTER_RESPONSE.format(i).encode())
+        else:
+            packets.append(MEDIA_RENDERER_RESPONSE.format(i % 250, i).encode())
+    return packets
+
+
+def parse_email(packets, buffer):
+    for packet in packets:
+        dict(SSDPResponse.parse(packet.decode()).headers)
+
+
+def parse_fast(packets, buffer):
+    for packet in packets:
+        # Mimic recvfrom_into filling the reused receive buffer
+        length = len(packet)
+        buffer[:length] = packet
+        parse_ssdp_headers(buffer, length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=500, help='Datagrams parsed per run.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per parser, the best is reported.')
+    args = parser.parse_args()
+
+    packets = make_packets(args.packets)
+    buffer = bytearray(4096)
+
+    template = "{0:20}{1:>15}{2:>20}"
+    print(template.format("PARSER", "BEST (ms)", "PER PACKET (us)"))
+
+    results = {}
+    for name, func in (('email.parser', parse_email), ('parse_ssdp_headers', parse_fast)):
+        best = min(timeit.repeat(lambda: func(packets, buffer), number=1, repeat=args.repeat))
+        results[name] = best
+        print(template.format(name, '%.2f' % (best * 1000), '%.2f' % (best * 1e6 / len(packets))))
+
+    print()
+    print('Speedup: %.1fx' % (results['email.parser'] / results['parse_ssdp_headers']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Measures CLI startup for each command: wall time of running main.py, and the import time reported
+by python -X importtime, broken down by the heaviest top-level imports. Each command really runs,
+including the imports its handler defers until it is called, against the in-process fake IGD in
+fake_igd.py. The router is found in a router cache filled before the runs, so only daemon start,
+which would not return, is run with --help.
+
+    $ python3 benchmarks/bench_startup.py [--repeat 5] [--top 5] [--output startup.json]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, 'main.py')
+sys.path.insert(0, ROOT)
+
+# The CLI runs inherit these: a router cache holding only the fake IGD, and no daemon to answer
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='bench-startup-')
+os.environ['UPNP_DAEMON_SOCKET'] = os.path.join(os.environ['XDG_CACHE_HOME'], 'no-daemon.sock')
+
+from fake_igd import FakeIGD
+from ssdp import SSDP
+
+ROUTER = '{router}'
+MANIFEST = '{manifest}'
+
+# Adds and deletes of the same mapping alternate, so every repeat does the same work
+COMMANDS = [
+    [],
+    ['router', 'list'],
+    ['router', 'ip', '--router', ROUTER],
+    ['port', 'add', '--router', ROUTER, '--private-ip', '192.168.1.50', '--private-port', '8080'],
+    ['port', 'delete', '--router', ROUTER, '--public-port', '8080'],
+    ['port', 'list', '--router', ROUTER],
+    ['port', 'show', '--router', ROUTER, '--public-port', '1024'],
+    ['port', 'apply', '--router', ROUTER, '--file', MANIFEST],
+    ['port', 'sync', '--router', ROUTER, '--file', MANIFEST],
+    ['fleet', 'list'],
+    ['fleet', 'apply', '--file', MANIFEST],
+    ['fleet', 'sync', '--file', MANIFEST],
+    ['daemon', 'metrics'],
+    ['daemon', 'start', '--help'],
+]
+
+
+def parse_importtime(stderr):
+    """Returns {module: cumulative microseconds} for the modules imported at the top level."""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented under the module that imported them
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def run(command, repeat):
+    best_wall = None
+    best_imports = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', MAIN] + command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        wall = time.perf_counter() - start
+        if best_wall is None or wall < best_wall:
+            best_wall = wall
+            best_imports = parse_importtime(result.stderr)
+    return best_wall, best_imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per command, the fastest is reported.')
+    parser.add_argument('--top', type=int, default=5, help='Number of heaviest imports to list.')
+    parser.add_argument('--output', help='Also write the results to this JSON file.')
+    args = parser.parse_args()
+
+    with FakeIGD(entries=10) as igd:
+        results = bench_commands(igd, args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def bench_commands(igd, args):
+    # Discover the fake IGD once, filling the router cache the CLI runs read
+    SSDP.multicast_host, SSDP.multicast_port = igd.ssdp_address
+    SSDP.response_time_secs = 0.2
+    SSDP.list(refresh=True)
+
+    manifest = os.path.join(os.environ['XDG_CACHE_HOME'], 'manifest.json')
+    with open(manifest, 'w') as f:
+        json.dump([{'protocol': 'TCP', 'public_port': 9000, 'private_ip': '192.168.1.50', 'private_port': 9000}], f)
+
+    template = "{0:15}{1:>12}{2:>14}  {3}"
+    print(template.format("COMMAND", "WALL (ms)", "IMPORTS (ms)", "HEAVIEST IMPORTS (ms)"))
+
+    results = []
+    for command in COMMANDS:
+        command = [arg.format(router=igd.uuid, manifest=manifest) for arg in command]
+        wall, imports = run(command, args.repeat)
+        # site is imported before main.py runs and isn't affected by it
+        own_imports = {name: us for name, us in imports.items() if name != 'site'}
+        heaviest = sorted(own_imports.items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+        name = ' '.join(command[:2]) or '(help)'
+        print(template.format(
+            name,
+            '%.1f' % (wall * 1000),
+            '%.1f' % (sum(own_imports.values()) / 1000),
+            ', '.join('%s %.1f' % (module, us / 1000) for module, us in heaviest)
+        ))
+        results.append({
+            'command': name,
+            'wall_ms': wall * 1000,
+            'import_ms': sum(own_imports.values()) / 1000,
+            'imports_ms': {module: us / 1000 for module, us in heaviest}
+        })
+    return results
+
+
+if __name__ == '__main__':
+    main()
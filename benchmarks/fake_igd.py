@@ -0,0 +1,275 @@
+"""
+An in-process fake Internet Gateway Device for benchmarks: an SSDP responder answering M-SEARCH on
+loopback, and an HTTP server serving its device description and the WANIPConnection:1 port
+mapping SOAP actions (plus GetExternalIPAddress) on an in-memory port mapping table.
+
+    igd = FakeIGD(entries=1000, latency_secs=0.002, fault_rate=0.01)
+    with igd:
+        SSDP.multicast_host, SSDP.multicast_port = igd.ssdp_address
+        ...
+"""
+
+import re
+import time
+import random
+import socket
+import threading
+from xml.sax.saxutils import escape, unescape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SERVICE_TYPE = 'urn:schemas-upnp-org:service:WANIPConnection:1'
+CONTROL_PATH = '/ctl/IPConn'
+DESCRIPTION_PATH = '/rootDesc.xml'
+
+DESCRIPTION = '''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+<specVersion><major>1</major><minor>0</minor></specVersion>
+<device>
+<deviceType>urn:schemas-upnp-org:device:InternetGatewayDevice:1</deviceType>
+<friendlyName>Fake IGD</friendlyName>
+<serialNumber>{serial}</serialNumber>
+<UDN>uuid:{uuid}</UDN>
+<deviceList><device>
+<deviceType>urn:schemas-upnp-org:device:WANDevice:1</deviceType>
+<deviceList><device>
+<deviceType>urn:schemas-upnp-org:device:WANConnectionDevice:1</deviceType>
+<serviceList><service>
+<serviceType>{service_type}</serviceType>
+<serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>
+<controlURL>{control_path}</controlURL>
+</service></serviceList>
+</device></deviceList>
+</device></deviceList>
+</device>
+</root>'''
+
+RESPONSE = (
+    '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+    '<u:{action}Response xmlns:u="{service_type}">{arguments}</u:{action}Response>'
+    '</s:Body></s:Envelope>'
+)
+
+FAULT = (
+    '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><s:Fault>'
+    '<faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring><detail>'
+    '<UPnPError xmlns="urn:schemas-upnp-org:control-1-0"><errorCode>{code}</errorCode>'
+    '<errorDescription>{description}</errorDescription></UPnPError></detail>'
+    '</s:Fault></s:Body></s:Envelope>'
+)
+
+SEARCH_RESPONSE = (
+    'HTTP/1.1 200 OK\r\n'
+    'CACHE-CONTROL: max-age=120\r\n'
+    'EXT:\r\n'
+    'LOCATION: {location}\r\n'
+    'SERVER: Linux/5.4 UPnP/1.1 FakeIGD/1.0\r\n'
+    'ST: {st}\r\n'
+    'USN: uuid:{uuid}::{st}\r\n'
+    '\r\n'
+)
+
+_argument_pattern = re.compile(r'<(New\w+)>([^<]*)</\1>')
+
+
+class FakeIGD:
+    """
+    Args:
+        entries (int): Number of port mappings the table starts with.
+        latency_secs (float): Delay added before answering each SOAP action.
+        fault_rate (float): Fraction of SOAP actions answered with a 501 ActionFailed fault.
+        uuid (str): The device UUID.
+        search_responses (int): How many times each M-SEARCH is answered, as real gateways repeat themselves.
+        only_permanent_leases (bool): Refuse mappings with a lease duration with 725 OnlyPermanentLeasesSupported.
+    """
+
+    def __init__(self, entries=0, latency_secs=0, fault_rate=0, uuid='fa4e1600-0000-4000-8000-000000000001',
+                 search_responses=2, only_permanent_leases=False):
+        self.latency_secs = latency_secs
+        self.fault_rate = fault_rate
+        self.uuid = uuid
+        self.search_responses = search_responses
+        self.only_permanent_leases = only_permanent_leases
+
+        # (remote_host, external_port, protocol) -> mapping, in insertion order for GetGeneric indexes
+        self.table = {}
+        self._index = None
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self.requests = 0
+
+        for i in range(entries):
+            port = 1024 + i
+            self.table[('', port, 'TCP')] = {
+                'NewRemoteHost': '',
+                'NewExternalPort': str(port),
+                'NewProtocol': 'TCP',
+                'NewInternalPort': str(port),
+                'NewInternalClient': '192.168.1.%d' % (2 + i % 250),
+                'NewEnabled': '1',
+                'NewPortMappingDescription': 'bench %d' % i,
+                'NewLeaseDuration': '0'
+            }
+
+        self._http = None
+        self._ssdp = None
+        self._threads = []
+
+    @property
+    def location(self):
+        return 'http://127.0.0.1:%d%s' % (self._http.server_port, DESCRIPTION_PATH)
+
+    @property
+    def ssdp_address(self):
+        """The (host, port) the SSDP responder listens on, to send M-SEARCH to instead of the multicast group."""
+        return self._ssdp.getsockname()
+
+    def start(self):
+        igd = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately, don't let Nagle hold the body back
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != DESCRIPTION_PATH:
+                    return self._send(404, b'')
+                body = DESCRIPTION.format(
+                    serial='FAKE0001',
+                    uuid=igd.uuid,
+                    service_type=SERVICE_TYPE,
+                    control_path=CONTROL_PATH
+                )
+                self._send(200, body.encode())
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                action = self.headers.get('SOAPACTION', '').strip('"').rsplit('#', 1)[-1]
+                arguments = {name: unescape(value) for name, value in _argument_pattern.findall(body)}
+                status, response = igd.handle_action(action, arguments)
+                self._send(status, response.encode())
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._http = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._http.daemon_threads = True
+
+        self._ssdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._ssdp.bind(('127.0.0.1', 0))
+
+        self._threads = [
+            threading.Thread(target=self._http.serve_forever, daemon=True),
+            threading.Thread(target=self._serve_ssdp, daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._http.shutdown()
+        self._http.server_close()
+        self._ssdp.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle_action(self, action, arguments):
+        """Returns the (HTTP status, SOAP body) answering an action."""
+        if self.latency_secs:
+            time.sleep(self.latency_secs)
+
+        with self._lock:
+            self.requests += 1
+            if self.fault_rate and self._random.random() < self.fault_rate:
+                return self._fault(501, 'ActionFailed')
+
+            handler = getattr(self, '_' + action, None)
+            if handler is None:
+                return self._fault(401, 'Invalid Action')
+            return handler(arguments)
+
+    def _GetGenericPortMappingEntry(self, arguments):
+        if self._index is None:
+            self._index = list(self.table.values())
+        index = int(arguments.get('NewPortMappingIndex', -1))
+        if not 0 <= index < len(self._index):
+            return self._fault(713, 'SpecifiedArrayIndexInvalid')
+        return self._response('GetGenericPortMappingEntry', self._index[index])
+
+    def _AddPortMapping(self, arguments):
+        if self.only_permanent_leases and arguments.get('NewLeaseDuration', '0') != '0':
+            return self._fault(725, 'OnlyPermanentLeasesSupported')
+
+        key = self._key(arguments)
+        existing = self.table.get(key)
+        if existing is not None and existing['NewInternalClient'] != arguments.get('NewInternalClient'):
+            return self._fault(718, 'ConflictInMappingEntry')
+
+        self.table[key] = {name: arguments.get(name, '') for name in (
+            'NewRemoteHost', 'NewExternalPort', 'NewProtocol', 'NewInternalPort', 'NewInternalClient',
+            'NewEnabled', 'NewPortMappingDescription', 'NewLeaseDuration'
+        )}
+        self._index = None
+        return self._response('AddPortMapping', {})
+
+    def _DeletePortMapping(self, arguments):
+        if self.table.pop(self._key(arguments), None) is None:
+            return self._fault(714, 'NoSuchEntryInArray')
+        self._index = None
+        return self._response('DeletePortMapping', {})
+
+    def _GetSpecificPortMappingEntry(self, arguments):
+        mapping = self.table.get(self._key(arguments))
+        if mapping is None:
+            return self._fault(714, 'NoSuchEntryInArray')
+        return self._response('GetSpecificPortMappingEntry', {
+            name: value for name, value in mapping.items()
+            if name not in ('NewRemoteHost', 'NewExternalPort', 'NewProtocol')
+        })
+
+    def _GetExternalIPAddress(self, arguments):
+        return self._response('GetExternalIPAddress', {'NewExternalIPAddress': '203.0.113.1'})
+
+    def _key(self, arguments):
+        return (arguments.get('NewRemoteHost', ''), int(arguments.get('NewExternalPort', 0)), arguments.get('NewProtocol', '').upper())
+
+    def _response(self, action, arguments):
+        body = ''.join('<{0}>{1}</{0}>'.format(name, escape(value)) for name, value in arguments.items())
+        return (200, RESPONSE.format(action=action, service_type=SERVICE_TYPE, arguments=body))
+
+    def _fault(self, code, description):
+        return (500, FAULT.format(code=code, description=description))
+
+    def _serve_ssdp(self):
+        while True:
+            try:
+                data, sender = self._ssdp.recvfrom(4096)
+            except OSError:
+                return
+
+            if not data.startswith(b'M-SEARCH'):
+                continue
+            st = next((line.split(b':', 1)[1].strip().decode() for line in data.split(b'\r\n')
+                       if line.upper().startswith(b'ST:')), '')
+            if st not in (SERVICE_TYPE, 'ssdp:all', 'upnp:rootdevice'):
+                continue
+
+            response = SEARCH_RESPONSE.format(location=self.location, st=st, uuid=self.uuid).encode()
+            for _ in range(self.search_responses):
+                self._ssdp.sendto(response, sender)
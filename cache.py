@@ -0,0 +1,128 @@
+import time
+import threading
+from fcache.cache import FileCache
+
+class RouterCache:
+    """
+    Caches discovered routers on disk as plain, versioned records, one entry per router UUID.
+    Every entry expires on its own after the max-age its router advertised in CACHE-CONTROL, so a
+    single stale router only has to be revalidated itself instead of forcing a full search.
+    """
+
+    # Records written with a different version are ignored, so the record layout can change safely
+    version = 1
+    # Used for routers that did not send CACHE-CONTROL: max-age
+    default_max_age_secs = 300
+    # How long the result of a full search is trusted to contain every router on the network
+    search_max_age_secs = 300
+
+    _router_key_prefix = 'router:'
+    _search_key = 'search'
+
+    def __init__(self, appname='upnp-routers'):
+        self._cache = FileCache(appname, 'cs')
+        self._lock = threading.Lock()
+
+    def get(self, uuid, margin_secs=0):
+        """
+        Args:
+            uuid (str): The router's UUID.
+            margin_secs (float): Also count the entry as expired if it expires within this many seconds.
+        Returns:
+            Tuple[dict, bool]: The router record and whether it has expired, or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._read(self._router_key_prefix + uuid)
+        if entry is None:
+            return None
+        return (entry['record'], entry['expires'] <= time.time() + margin_secs)
+
+    def put(self, record, max_age=None):
+        """Stores a router record, expiring after max_age seconds."""
+        if not record.get('uuid'):
+            return
+
+        entry = {
+            'version': RouterCache.version,
+            'expires': time.time() + (max_age or RouterCache.default_max_age_secs),
+            'record': record
+        }
+        with self._lock:
+            self._cache[self._router_key_prefix + record['uuid']] = entry
+
+    def remove(self, uuid):
+        with self._lock:
+            self._cache.pop(self._router_key_prefix + uuid, None)
+
+    def all(self, margin_secs=0):
+        """
+        Args:
+            margin_secs (float): Also count entries as expired if they expire within this many seconds.
+        Returns:
+            List[Tuple[dict, bool]]: Every cached router record and whether it has expired, or None if
+            there has been no full search within search_max_age_secs.
+        """
+        with self._lock:
+            search = self._read(self._search_key)
+            if search is None or search['expires'] <= time.time():
+                return None
+
+            now = time.time() + margin_secs
+            entries = []
+            for key in list(self._cache):
+                if key.startswith(self._router_key_prefix):
+                    entry = self._read(key)
+                    if entry is not None:
+                        entries.append((entry['record'], entry['expires'] <= now))
+
+        # Keep the order routers were found in by the last full search
+        order = {uuid: i for i, uuid in enumerate(search['uuids'])}
+        entries.sort(key=lambda e: order.get(e[0]['uuid'], len(order)))
+        return entries
+
+    def searched_at(self):
+        """Returns when the last full search finished, or None if there has been none."""
+        with self._lock:
+            search = self._read(self._search_key)
+        if search is None:
+            return None
+        return search.get('searched_at', search['expires'] - RouterCache.search_max_age_secs)
+
+    def replace_all(self, records):
+        """
+        Replaces every cached router with the results of a full search.
+        Args:
+            records (List[Tuple[dict, int]]): (router record, max-age) pairs.
+        """
+        with self._lock:
+            for key in list(self._cache):
+                if key.startswith(self._router_key_prefix):
+                    del self._cache[key]
+
+        for record, max_age in records:
+            self.put(record, max_age)
+
+        now = time.time()
+        with self._lock:
+            self._cache[self._search_key] = {
+                'version': RouterCache.version,
+                'searched_at': now,
+                'expires': now + RouterCache.search_max_age_secs,
+                'uuids': [record['uuid'] for record, _ in records if record.get('uuid')]
+            }
+
+    def close(self):
+        self._cache.close()
+
+    def _read(self, key):
+        try:
+            entry = self._cache[key]
+        except KeyError:
+            return None
+        except Exception:
+            # Unreadable leftovers, e.g. written by an incompatible version of this tool
+            return None
+
+        if not isinstance(entry, dict) or entry.get('version') != RouterCache.version:
+            return None
+        return entry
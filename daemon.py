@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import signal
+import socket
+import struct
+import asyncio
+import threading
+
+import daemon_client
+from cache import RouterCache
+from ssdp import SSDP, Router, parse_ssdp_notify
+from upnp import UPnp, PortMapping
+from lease import LeaseScheduler
+from metrics import Metrics
+
+class NotifyProtocol(asyncio.DatagramProtocol):
+    """Hands every ssdp:alive and ssdp:byebye NOTIFY received on the multicast group to the daemon."""
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def datagram_received(self, data, addr):
+        headers = parse_ssdp_notify(data)
+        if headers is not None:
+            self.daemon.handle_notify(headers, addr)
+
+    def error_received(self, exc):
+        print('NOTIFY socket error: %s' % exc)
+
+
+class Daemon:
+    """
+    Long running process that keeps a live table of routers and answers CLI commands over a Unix
+    socket, so each CLI call is a local round-trip to a warm process with pooled router connections.
+
+    The table is filled by an M-SEARCH at startup and kept current by listening for the ssdp:alive
+    and ssdp:byebye NOTIFYs routers multicast. The network is only searched again when the table
+    is empty or a router's advertisement expires without being renewed.
+
+    Port mappings added through the daemon with a lease duration are renewed by its LeaseScheduler
+    until they are deleted through it again.
+    """
+
+    # How often the table is checked for expired routers
+    check_interval_secs = 30
+    # Rows fetched ahead of a streaming client before fetching waits for it to catch up
+    stream_queue_size = 256
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or daemon_client.socket_path()
+        self.routers = {}
+        self.expires = {}
+        self.usns = {}
+        self.locations = {}
+
+        self.leases = LeaseScheduler()
+
+        self._describing = set()
+        self._search_task = None
+        self._cache = None
+        self._loop = None
+
+    def run(self):
+        """Runs the daemon until interrupted."""
+        # Stop the same way on SIGTERM as on Ctrl-C, so the socket file is removed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def _serve(self):
+        if not daemon_client.make_socket_dir(self.socket_path):
+            print('Not starting, %s belongs to another user' % os.path.dirname(self.socket_path))
+            return
+        if os.path.exists(self.socket_path):
+            if daemon_client.is_listening(self.socket_path):
+                print('Not starting, a daemon is already listening on %s' % self.socket_path)
+                return
+            # Left behind by a daemon that didn't exit cleanly
+            os.unlink(self.socket_path)
+
+        # Join the multicast group before creating the Unix socket, so failing to doesn't leave a
+        # socket file behind
+        try:
+            notify_sock = self._create_notify_socket()
+        except OSError as e:
+            print('Not starting, could not listen for SSDP announcements on port %d: %s'
+                  % (SSDP.multicast_port, e.strerror or e))
+            return
+
+        Metrics.enable()
+        self._loop = asyncio.get_running_loop()
+        transport, _ = await self._loop.create_datagram_endpoint(lambda: NotifyProtocol(self), sock=notify_sock)
+        try:
+            server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        except OSError as e:
+            transport.close()
+            print('Not starting, could not listen on %s: %s' % (self.socket_path, e.strerror or e))
+            return
+        os.chmod(self.socket_path, 0o600)
+        self._cache = RouterCache()
+
+        print('Listening for CLI commands on %s' % self.socket_path)
+
+        self.leases.start()
+        try:
+            self.search()
+            while True:
+                await asyncio.sleep(Daemon.check_interval_secs)
+                self._expire()
+        finally:
+            self.leases.stop()
+            transport.close()
+            server.close()
+            self._cache.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _create_notify_socket(self):
+        """Creates a socket joined to the SSDP multicast group, shared with any other SSDP listener."""
+        sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM, proto=socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', SSDP.multicast_port))
+
+            membership = struct.pack('4s4s', socket.inet_aton(SSDP.multicast_host), socket.inet_aton('0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def search(self):
+        """Starts an M-SEARCH in the background, unless one is already running."""
+        if self._search_task is None or self._search_task.done():
+            self._search_task = self._loop.create_task(self._search())
+        return self._search_task
+
+    async def _search(self):
+        async for router in SSDP.discover():
+            self._add_router(router)
+
+    def handle_notify(self, headers, sender):
+        usn = headers.get('USN', '')
+
+        if headers.get('NTS') == 'ssdp:byebye':
+            uuid = self.usns.get(usn)
+            if uuid is None:
+                # Gateways also say goodbye for their root device, identify the router by UUID instead
+                uuid = usn.split('::')[0].replace('uuid:', '', 1)
+            self._remove_router(uuid)
+            return
+
+        if headers.get('NTS') != 'ssdp:alive' or headers.get('NT') not in SSDP.gateway_search_targets:
+            return
+        if 'LOCATION' not in headers:
+            return
+
+        location = headers['LOCATION']
+        uuid = self.locations.get(location)
+        if uuid in self.routers:
+            # A router we already know renewing its advertisement
+            self.expires[uuid] = time.time() + (self.routers[uuid].max_age or RouterCache.default_max_age_secs)
+            self.usns[usn] = uuid
+            return
+
+        if location not in self._describing:
+            headers = dict(headers, ST=headers['NT'])
+            router = Router.parse_ssdp_headers(headers, sender)
+            self._describing.add(location)
+            self._loop.create_task(self._describe(router))
+
+    async def _describe(self, router):
+        try:
+            SSDP._describe_router(router, await SSDP._fetch_description_async(router.url))
+        finally:
+            self._describing.discard(router.url)
+
+        if router.uuid and router.control_url:
+            self._add_router(router)
+
+    def _add_router(self, router):
+        if router.uuid not in self.routers:
+            print('Found router %s at %s' % (router.uuid, router.url))
+            self.routers[router.uuid] = router
+            self._cache.put(router.to_record(), router.max_age)
+
+        self.expires[router.uuid] = time.time() + (router.max_age or RouterCache.default_max_age_secs)
+        self.locations[router.url] = router.uuid
+        if router.usn:
+            self.usns[router.usn] = router.uuid
+
+    def _remove_router(self, uuid):
+        router = self.routers.pop(uuid, None)
+        if router is None:
+            return
+
+        print('Router %s went away' % uuid)
+        self.expires.pop(uuid, None)
+        self.locations = {l: u for l, u in self.locations.items() if u != uuid}
+        self.usns = {n: u for n, u in self.usns.items() if u != uuid}
+        self._cache.remove(uuid)
+
+    def _expire(self):
+        now = time.time()
+        expired = [uuid for uuid, expires in self.expires.items() if expires <= now]
+        for uuid in expired:
+            self._remove_router(uuid)
+
+        # Routers that stop advertising may only have missed NOTIFYs, search to find them again
+        if expired or not self.routers:
+            self.search()
+
+    async def _stream_port_mappings(self, args, writer):
+        """
+        Sends a router's port mappings to a client as {"row": ...} lines, each as soon as it is
+        fetched. Fetching runs in a thread and waits whenever stream_queue_size rows are queued up
+        for a slow client, so memory doesn't grow with the size of the table.
+        """
+        Metrics.count('daemon_requests', command='port list')
+        router = await self._get_router(args['router'])
+
+        queue = asyncio.Queue(maxsize=Daemon.stream_queue_size)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), self._loop).result()
+
+        def fetch():
+            end = done
+            try:
+                for portmap in UPnp.iter_port_mappings(router):
+                    if stopped.is_set():
+                        return
+                    put(portmap)
+            except Exception as e:
+                end = e
+            if not stopped.is_set():
+                put(end)
+
+        self._loop.run_in_executor(None, fetch)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    return None
+                if isinstance(item, Exception):
+                    raise item
+                writer.write(json.dumps({'row': item.to_dict()}).encode() + b'\n')
+                await writer.drain()
+        finally:
+            # Let a fetch blocked on a full queue see that the client is gone
+            stopped.set()
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def _get_router(self, uuid):
+        router = await self._find_router(uuid)
+        if router is None:
+            raise LookupError('No router found with uuid "%s"' % uuid)
+        return router
+
+    async def _find_router(self, uuid):
+        router = self.routers.get(uuid)
+        if router is None:
+            router = await self._loop.run_in_executor(None, SSDP.find, uuid)
+            if router is not None:
+                self._add_router(router)
+        return router
+
+    async def _handle_client(self, reader, writer):
+        try:
+            line = await reader.readline()
+            try:
+                request = json.loads(line)
+                if request['command'] == 'port list':
+                    result = await self._stream_port_mappings(request.get('args', {}), writer)
+                else:
+                    result = await self._execute(request['command'], request.get('args', {}))
+                response = {'ok': True, 'result': result}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e) or e.__class__.__name__}
+
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        except ConnectionError:
+            # The client went away, e.g. stopped reading a stream
+            pass
+        finally:
+            writer.close()
+
+    async def _execute(self, command, args):
+        Metrics.count('daemon_requests', command=command)
+
+        if command == 'metrics':
+            return Metrics.snapshot()
+
+        if command == 'router list':
+            if args.get('refresh') or not self.routers:
+                await self.search()
+            return [r.to_record() for r in self.routers.values()]
+
+        router = await self._get_router(args['router'])
+
+        if command == 'port show':
+            find = lambda: UPnp.find_port_mapping(router, args['public_port'], args['protocol'])
+            portmap = await self._loop.run_in_executor(None, find)
+            return [portmap.to_dict()] if portmap is not None else []
+
+        if command == 'port add':
+            changes = [('add', PortMapping(
+                public_port=args['public_port'],
+                protocol=args['protocol'],
+                private_ip=args['private_ip'],
+                private_port=args['private_port'],
+                lease_duration=args.get('lease_duration', 0)
+            ))]
+        elif command == 'port delete':
+            changes = [('delete', PortMapping(public_port=args['public_port'], protocol=args['protocol']))]
+        elif command in ('port apply', 'port sync'):
+            changes = [(action, PortMapping(**portmap)) for action, portmap in args['changes']]
+        else:
+            raise ValueError('Unknown command "%s"' % command)
+
+        if command == 'port sync':
+            apply = lambda: UPnp.sync_router_port_mappings(router, changes, args.get('prune', False))
+        else:
+            apply = lambda: UPnp.apply_router_port_mappings(router, changes)
+
+        results = await self._loop.run_in_executor(None, apply)
+        for result in results:
+            if result.action == 'add' and result.success:
+                self.leases.add(router, result.portmap)
+            elif result.action == 'delete' and result.success:
+                self.leases.remove(router, result.portmap)
+
+        if command == 'port sync':
+            # Leased mappings that were already in place still have to be renewed, but how much of
+            # their lease is left is unknown, so renew them right away
+            changed = set(UPnp._port_mapping_key(r.portmap) for r in results)
+            for action, portmap in changes:
+                if action == 'add' and UPnp._port_mapping_key(portmap) not in changed:
+                    self.leases.add(router, portmap, renew_in=0)
+
+        return [[r.action, r.portmap.to_dict(), r.error] for r in results]
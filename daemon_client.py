@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import socket
+import tempfile
+
+# Kept free of heavy imports: the CLI imports this on every call to check for a running daemon.
+
+request_timeout_secs = 120
+
+def socket_path():
+    """Path of the daemon's Unix socket, overridable with the UPNP_DAEMON_SOCKET environment variable."""
+    path = os.environ.get('UPNP_DAEMON_SOCKET')
+    if path:
+        return path
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'upnp-%d.sock' % os.getuid())
+
+    # The temp directory is shared with every other user, so the socket goes in a private
+    # directory there, see make_socket_dir
+    return os.path.join(tempfile.gettempdir(), 'upnp-%d' % os.getuid(), 'daemon.sock')
+
+def make_socket_dir(path):
+    """
+    Creates the directory of the socket at path if needed, private to the current user when it is
+    created here. Returns False if it exists but belongs to another user, who could then swap the
+    socket out; directories owned by root, like /tmp itself, are fine.
+    """
+    directory = os.path.dirname(path) or '.'
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    return os.stat(directory).st_uid in (os.getuid(), 0)
+
+def is_trusted(path):
+    """
+    Whether the socket at path was created by the current user. Anyone else could have planted it
+    to impersonate the daemon, e.g. in a shared directory.
+    """
+    try:
+        return os.stat(path).st_uid == os.getuid()
+    except OSError:
+        return False
+
+def is_listening(path):
+    """Whether a process is accepting connections on the Unix socket at path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+        return True
+
+class DaemonError(Exception):
+    """An error the daemon reported while streaming a command's results."""
+
+
+def request(command, **args):
+    """
+    Sends a command to the running daemon.
+    Args:
+        command (str): The CLI command, e.g. 'port show'.
+        args: The command's arguments.
+    Returns:
+        dict: The daemon's response, {"ok": true, "result": ...} or {"ok": false, "error": "..."},
+        or None if no daemon is running.
+    """
+    sock = _connect(command, args)
+    if sock is None:
+        return None
+
+    chunks = []
+    try:
+        with sock:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if chunk.endswith(b'\n'):
+                    break
+    except OSError:
+        return None
+
+    if not chunks:
+        return None
+    return json.loads(b''.join(chunks))
+
+def stream(command, **args):
+    """
+    Sends a command whose results the daemon streams back, one {"row": ...} line each, followed
+    by the usual response line.
+    Returns:
+        Iterator[dict]: The rows as they arrive, raising DaemonError if the command failed, or None
+        if no daemon is running.
+    """
+    sock = _connect(command, args)
+    if sock is None:
+        return None
+    return _read_rows(sock)
+
+def _read_rows(sock):
+    with sock, sock.makefile('rb') as lines:
+        for line in lines:
+            message = json.loads(line)
+            if 'row' in message:
+                yield message['row']
+            elif not message['ok']:
+                raise DaemonError(message['error'])
+            else:
+                return
+    raise DaemonError('The daemon closed the connection')
+
+def _connect(command, args):
+    """Connects to the daemon and sends a command. Returns the socket, or None if no daemon is running."""
+    path = socket_path()
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    if not is_trusted(path):
+        print('Ignoring %s, it does not belong to the current user' % path, file=sys.stderr)
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(request_timeout_secs)
+        sock.connect(path)
+        sock.sendall(json.dumps({'command': command, 'args': args}).encode() + b'\n')
+    except OSError:
+        # A stale socket file left behind by a daemon that is no longer running
+        sock.close()
+        return None
+    return sock
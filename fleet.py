@@ -0,0 +1,107 @@
+import fnmatch
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ssdp import SSDP
+from upnp import UPnp
+from session import SessionPool
+
+class FleetResult:
+    """The outcome of an operation on one router of a fleet: its value, or why it failed."""
+
+    def __init__(self, router, value=None, error=None):
+        self.router = router
+        self.value = value
+        self.error = error
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+class Fleet:
+    """
+    Runs port mapping operations on many routers at once. Routers are discovered a single time and
+    then worked on concurrently, at most max_concurrency at a time, and results are handed back as
+    each router finishes rather than once the slowest one has.
+
+    How fast each router, and all of them together, are sent requests is limited through
+    SessionPool.router_rate_limit and SessionPool.max_in_flight. Routers that recently stopped
+    answering (see CircuitBreaker) are skipped rather than waited on.
+    """
+
+    # Maximum number of routers worked on at the same time
+    max_concurrency = 16
+
+    @classmethod
+    def routers(cls, uuids=None, networks=None, types=None, refresh=False):
+        """
+        Discovers routers once and returns those matching every given filter.
+        Args:
+            uuids (List[str]): Shell-style patterns matched against the router UUID, e.g. 'a1b2*'.
+            networks (List[str]): Networks the router address must be in, e.g. '192.168.0.0/16'.
+            types (List[str]): Substrings of the router's service type, e.g. 'WANPPPConnection'.
+            refresh (bool): Search the network even if the router cache is fresh.
+        Returns:
+            List[Router]
+        """
+        networks = [ipaddress.ip_network(n, strict=False) for n in networks or []]
+
+        routers = []
+        for router in SSDP.list(refresh):
+            if uuids and not any(fnmatch.fnmatch(router.uuid or '', pattern) for pattern in uuids):
+                continue
+            if networks and not Fleet._in_networks(router.ip, networks):
+                continue
+            if types and not any(t in router.type for t in types):
+                continue
+            routers.append(router)
+        return routers
+
+    @classmethod
+    def list_port_mappings(cls, routers):
+        """Yields a FleetResult with each router's list of PortMapping, as each router finishes."""
+        return Fleet._run(routers, UPnp.get_port_mappings)
+
+    @classmethod
+    def apply_port_mappings(cls, routers, changes):
+        """Applies (action, PortMapping) changes to every router, see UPnp.apply_port_mappings."""
+        return Fleet._run(routers, lambda router: UPnp.apply_router_port_mappings(router, changes))
+
+    @classmethod
+    def sync_port_mappings(cls, routers, changes, prune=False):
+        """Syncs every router with the same changes, see UPnp.sync_port_mappings."""
+        return Fleet._run(routers, lambda router: UPnp.sync_router_port_mappings(router, changes, prune))
+
+    @classmethod
+    def _run(cls, routers, operation):
+        available = []
+        for router in routers:
+            if SessionPool.is_available(router.base_url):
+                available.append(router)
+            else:
+                yield FleetResult(router, error='Skipped, the router has stopped answering')
+        routers = available
+
+        if not routers:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=min(Fleet.max_concurrency, len(routers)))
+        try:
+            futures = {executor.submit(operation, router): router for router in routers}
+            for future in as_completed(futures):
+                try:
+                    yield FleetResult(futures[future], value=future.result())
+                except Exception as e:
+                    yield FleetResult(futures[future], error=str(e) or e.__class__.__name__)
+        finally:
+            # Don't start on the remaining routers if the caller stopped reading results
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def _in_networks(cls, ip, networks):
+        try:
+            address = ipaddress.ip_address(ip.split('%')[0])
+        except ValueError:
+            return False
+        return any(address in network for network in networks)
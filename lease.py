@@ -0,0 +1,176 @@
+import time
+import heapq
+import itertools
+import threading
+
+from upnp import UPnp, PortMapping
+
+class LeaseScheduler:
+    """
+    Renews port mappings that were added with a lease duration shortly before their leases expire.
+
+    Renewals are kept in a heap ordered by when they can be sent, so each pass only looks at the
+    mappings that are actually due instead of every mapping being tracked. A renewal may be sent up
+    to coalesce_window_secs early, so that renewals due close together are sent to their router as
+    one batch over its pooled connections; for short leases the window shrinks to a quarter of the
+    renewal interval, so a renewed mapping is never due again within its own window. Failed
+    renewals are retried with exponential backoff. Routers that only accept permanent mappings get
+    the mapping added again with a lease of 0.
+    """
+
+    # Renew a mapping once this fraction of its lease has passed
+    renew_fraction = 0.8
+    # How early a renewal may be sent to batch it with others, at most a quarter of its renewal interval
+    coalesce_window_secs = 5
+    # Delay before retrying a failed renewal, doubled after every further failure
+    retry_backoff_secs = 5
+    max_retry_backoff_secs = 300
+
+    # UPnP error returned by routers that only accept leases of 0, meaning never expiring
+    _only_permanent_leases_error = 725
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, router, portmap, renew_in=None):
+        """
+        Starts renewing a port mapping that has been added with portmap.lease_duration.
+        Args:
+            router (Router): The router holding the mapping.
+            portmap (PortMapping): The mapping, as it was added.
+            renew_in (float): Seconds until the first renewal. Defaults to renew_fraction of the
+                lease, as for a mapping that has just been added.
+        """
+        if portmap.lease_duration <= 0:
+            # Not leased, or a permanent mapping that never needs renewing
+            self.remove(router, portmap)
+            return
+
+        if renew_in is None:
+            renew_in = portmap.lease_duration * LeaseScheduler.renew_fraction
+        with self._lock:
+            self._schedule(router, portmap, 0, time.time() + renew_in)
+        self._wakeup.set()
+
+    @classmethod
+    def coalesce_window(cls, portmap):
+        """Returns how many seconds before it is due a renewal of portmap may be sent."""
+        return min(LeaseScheduler.coalesce_window_secs, portmap.lease_duration * LeaseScheduler.renew_fraction / 4)
+
+    def remove(self, router, portmap):
+        """Stops renewing a port mapping, e.g. because it has been deleted."""
+        with self._lock:
+            # The heap entry is left in place and skipped once it comes up
+            self._entries.pop(LeaseScheduler._key(router, portmap), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def next_due(self):
+        """Returns when the next renewal can be sent, or None if there is nothing to renew."""
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def run_pending(self, now=None):
+        """
+        Renews every mapping that is due, or due within its coalesce_window.
+        Returns:
+            List[PortMappingResult]: The result of each renewal.
+        """
+        now = time.time() if now is None else now
+
+        batches = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, seq, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry[3] != seq:
+                    continue
+                router, portmap, failures, _ = entry
+                batches.setdefault(router.uuid, (router, []))[1].append((portmap, failures))
+
+        results = []
+        for router, renewals in batches.values():
+            permanent = []
+            changes = [('add', portmap) for portmap, _ in renewals]
+            batch_results = UPnp.apply_router_port_mappings(router, changes)
+
+            with self._lock:
+                for (portmap, failures), result in zip(renewals, batch_results):
+                    key = LeaseScheduler._key(router, portmap)
+                    entry = self._entries.get(key)
+                    if entry is None or entry[1] is not portmap:
+                        # Removed, or added again, while it was being renewed
+                        continue
+
+                    if result.success:
+                        self._schedule(router, portmap, 0, now + portmap.lease_duration * LeaseScheduler.renew_fraction)
+                    elif result.fault_code == LeaseScheduler._only_permanent_leases_error:
+                        # The renewal was refused, so the mapping is gone from the router by now
+                        print('Router %s only supports permanent port mappings, adding %s/%s without a lease'
+                              % (router.uuid, portmap.public_port, portmap.protocol))
+                        del self._entries[key]
+                        permanent.append(PortMapping(**dict(portmap.to_dict(), lease_duration=0)))
+                    else:
+                        backoff = min(LeaseScheduler.retry_backoff_secs * 2 ** failures, LeaseScheduler.max_retry_backoff_secs)
+                        print('Failed to renew port mapping %s/%s on router %s, retrying in %ds: %s'
+                              % (portmap.public_port, portmap.protocol, router.uuid, backoff, result.error))
+                        self._schedule(router, portmap, failures + 1, now + backoff, coalesce=False)
+
+            results.extend(batch_results)
+            if permanent:
+                results.extend(UPnp.apply_router_port_mappings(router, [('add', portmap) for portmap in permanent]))
+
+        return results
+
+    def start(self):
+        """Renews mappings from a daemon thread until stop() is called."""
+        if self._thread is not None:
+            return self._thread
+
+        def run():
+            while not self._stopped:
+                due = self.next_due()
+                timeout = None if due is None else max(due - time.time(), 0)
+                if self._wakeup.wait(timeout):
+                    # Woken up by a new mapping that may be due sooner, or by stop()
+                    self._wakeup.clear()
+                    continue
+                self.run_pending()
+
+        self._thread = threading.Thread(target=run, name='upnp-lease-renewal', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _schedule(self, router, portmap, failures, due, coalesce=True):
+        # Ordered by the start of the renewal's coalesce window rather than when it is due, except
+        # for retries, which must wait out their whole backoff
+        if coalesce:
+            due -= LeaseScheduler.coalesce_window(portmap)
+        seq = next(self._counter)
+        self._entries[LeaseScheduler._key(router, portmap)] = (router, portmap, failures, seq)
+        heapq.heappush(self._heap, (due, seq, LeaseScheduler._key(router, portmap)))
+
+    def _discard_stale(self):
+        # Drops heap entries left behind by removed or rescheduled mappings
+        while self._heap:
+            _, seq, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] == seq:
+                return
+            heapq.heappop(self._heap)
+
+    @classmethod
+    def _key(cls, router, portmap):
+        return (router.uuid, portmap.remote_host, portmap.public_port, portmap.protocol)
@@ -6,74 +6,166 @@ from collections import OrderedDict
 
 from knack import CLI, ArgumentsContext, CLICommandsLoader
 from knack.commands import CommandGroup
+from knack.events import EVENT_PARSER_GLOBAL_CREATE, EVENT_INVOKER_POST_PARSE_ARGS, EVENT_CLI_POST_EXECUTE
 
-from ssdp import SSDP, Router
-from upnp import UPnp
+# ssdp and upnp (and through them requests, asyncio and fcache) are imported by the commands that
+# use them, so each invocation only loads what its command needs. Commands are first sent to a
+# running daemon (see daemon.py) and only executed here if there is none.
 
 class CommandsLoader(CLICommandsLoader):
 
+    # The commands of each group, implemented by the <group>_<command> functions below
+    command_groups = OrderedDict([
+        ('router', ['list', 'ip']),
+        ('port', ['add', 'delete', 'list', 'show', 'apply', 'sync']),
+        ('fleet', ['list', 'apply', 'sync']),
+        ('daemon', ['start', 'metrics'])
+    ])
+
     def load_command_table(self, args):
-        with CommandGroup(self, 'router', '__main__#{}') as g:
-            g.command('list', 'router_list')
-        with CommandGroup(self, 'port', '__main__#{}') as g:
-            g.command('add', 'port_add')
-            g.command('delete', 'port_delete')
-            g.command('list', 'port_list')
+        # Only build the group being invoked, all of them are needed for the top level help
+        if args and args[0] in self.command_groups:
+            groups = [args[0]]
+        else:
+            groups = list(self.command_groups)
+
+        for group in groups:
+            with CommandGroup(self, group, '__main__#{}') as g:
+                for command in self.command_groups[group]:
+                    g.command(command, '{}_{}'.format(group, command))
         return OrderedDict(self.command_table)
 
     def load_arguments(self, command):
         with ArgumentsContext(self, 'router list') as ac:
             ac.argument('refresh', default=False)
+            ac.argument('interfaces', nargs='+', help="Interface names or local IPv4 addresses to search from, or 'all'.")
+            ac.argument('search_targets', nargs='+', help="SSDP search targets (ST) to search for.")
+            ac.argument('ipv6', action='store_true', help="Also search the IPv6 link-local multicast group.")
+            ac.argument('format', type=str, default='table', required=False, choices=['table', 'jsonl', 'csv'],
+                        help="table, or jsonl or csv to stream one row per router as it is fetched.")
+        with ArgumentsContext(self, 'router ip') as ac:
+            ac.argument('router', type=str, help="The router's UUID.")
         with ArgumentsContext(self, 'port add') as ac:
             ac.argument('router', type=str, help="The router's UUID.")
             ac.argument('protocol', type=str, default='TCP', required=False, help="TCP or UDP.")
             ac.argument('public_port', type=int, default=0, required=False)
             ac.argument('private_ip', type=str)
             ac.argument('private_port', type=int)
+            ac.argument('lease_duration', type=int, default=0, required=False,
+                        help="Seconds until the mapping expires, 0 for never. Renewed while the daemon runs.")
         with ArgumentsContext(self, 'port delete') as ac:
             ac.argument('router', type=str, help="The router's UUID.")
             ac.argument('protocol', type=str, default='TCP', required=False, help="TCP or UDP.")
             ac.argument('public_port', type=int, default=0, required=False)
         with ArgumentsContext(self, 'port list') as ac:
             ac.argument('router', type=str, help="The router's UUID.")
+            ac.argument('format', type=str, default='table', required=False, choices=['table', 'jsonl', 'csv'],
+                        help="table, or jsonl or csv to stream one row per port mapping as it is fetched.")
+        with ArgumentsContext(self, 'port show') as ac:
+            ac.argument('router', type=str, help="The router's UUID.")
+            ac.argument('protocol', type=str, default='TCP', required=False, help="TCP or UDP.")
+            ac.argument('public_port', type=int)
+        with ArgumentsContext(self, 'port apply') as ac:
+            ac.argument('router', type=str, help="The router's UUID.")
+            ac.argument('file', type=str, help="JSON or YAML manifest of port mappings to add or delete.")
+        with ArgumentsContext(self, 'port sync') as ac:
+            ac.argument('router', type=str, help="The router's UUID.")
+            ac.argument('file', type=str, help="JSON or YAML manifest of the wanted port mappings.")
+            ac.argument('prune', action='store_true', help="Delete mappings that are not in the manifest.")
+        with ArgumentsContext(self, 'fleet') as ac:
+            ac.argument('uuids', nargs='+', help="Only routers whose UUID matches one of these patterns, e.g. 'a1b2*'.")
+            ac.argument('networks', nargs='+', help="Only routers in one of these networks, e.g. 192.168.0.0/16.")
+            ac.argument('types', nargs='+', help="Only routers whose service type contains one of these, e.g. WANPPPConnection.")
+            ac.argument('refresh', action='store_true', help="Search the network even if the router cache is fresh.")
+            ac.argument('max_concurrency', type=int, help="Maximum number of routers worked on at once.")
+            ac.argument('rate_limit', type=float, help="Maximum number of requests per second sent to each router.")
+        with ArgumentsContext(self, 'fleet list') as ac:
+            ac.argument('format', type=str, default='table', required=False, choices=['table', 'jsonl', 'csv'],
+                        help="table, or jsonl or csv to stream one row per port mapping as it is fetched.")
+        with ArgumentsContext(self, 'fleet apply') as ac:
+            ac.argument('file', type=str, help="JSON or YAML manifest of port mappings to add or delete.")
+        with ArgumentsContext(self, 'fleet sync') as ac:
+            ac.argument('file', type=str, help="JSON or YAML manifest of the wanted port mappings.")
+            ac.argument('prune', action='store_true', help="Delete mappings that are not in the manifest.")
+        with ArgumentsContext(self, 'daemon start') as ac:
+            ac.argument('socket', type=str, help="Path of the Unix socket to listen on.")
+        with ArgumentsContext(self, 'daemon metrics') as ac:
+            ac.argument('format', type=str, default='table', required=False, help="table, json or prometheus.")
 
         super(CommandsLoader, self).load_arguments(command)
 
-def router_list(refresh=False):
+def router_list(refresh=False, interfaces=None, search_targets=None, ipv6=False, format='table'):
     # print("[router_list] refresh=%s" % refresh)
+    from ssdp import SSDP, Router
+
+    if interfaces or search_targets or ipv6:
+        if interfaces == ['all']:
+            interfaces = 'all'
+        routers = SSDP.iter_search(interfaces=interfaces, search_targets=search_targets, ipv6=ipv6)
+    else:
+        records = _daemon_request('router list', refresh=bool(refresh))
+        if records is False:
+            return
+        elif records is not None:
+            routers = [Router.from_record(record) for record in records]
+        else:
+            # Each router is printed as soon as it has been described
+            routers = SSDP.iter_routers(refresh)
+
+    if format != 'table':
+        from output import RowWriter
 
-    routers = SSDP.list(refresh)
+        writer = RowWriter(format, ['server', 'uuid', 'type', 'url', 'interface', 'serial_number', 'control_url'])
+        for r in routers:
+            writer.write(dict(r.to_record(), server="%s:%d" % (r.ip, r.port)))
+        return
 
     print()
-    template = "{0:20}{1:40}{2:50}{3:50}"
-    print(template.format("SERVER", "UUID", "TYPE", "URL"))
+    template = "{0:20}{1:40}{2:50}{3:50}{4:15}"
+    print(template.format("SERVER", "UUID", "TYPE", "URL", "INTERFACE"))
 
     for r in routers:
         print(template.format(
             "%s:%d" % (r.ip, r.port),
             r.uuid,
             r.type,
-            r.url
-        ))
+            r.url,
+            r.interface or '-'
+        ), flush=True)
+
+def router_ip(router):
+    from upnp import UPnp
+
+    UPnp.print_external_ip_address(router_uuid=router)
 
-def port_add(router, protocol, public_port, private_ip, private_port):
+def port_add(router, protocol, public_port, private_ip, private_port, lease_duration=0):
     if not public_port:
         public_port = private_port
 
     # print("[port_add] router=%s protocol=%s public_port=%d private_ip=%s private_port=%s" \
     #         % (router, protocol, public_port, private_ip, private_port))
-    
+    if _daemon_results('port add', router=router, protocol=protocol, public_port=public_port,
+                       private_ip=private_ip, private_port=private_port, lease_duration=lease_duration):
+        return
+
+    from upnp import UPnp
+
     UPnp.add_port_mapping(
         router_uuid=router,
         protocol=protocol,
         public_port=public_port,
         private_ip=private_ip,
-        private_port=private_port
+        private_port=private_port,
+        lease_duration=lease_duration
     )
 
 def port_delete(router, protocol, public_port):
     # print("[port_delete] router=%s protocol=%s public_port=%d" \
     #         % (router, protocol, public_port))
+    if _daemon_results('port delete', router=router, protocol=protocol, public_port=public_port):
+        return
+
+    from upnp import UPnp
 
     UPnp.delete_port_mapping(
         router_uuid=router,
@@ -81,21 +173,341 @@ def port_delete(router, protocol, public_port):
         public_port=public_port
     )
 
-def port_list(router):
-    UPnp.list_port_mappings(router_uuid=router)
+def port_list(router, format='table'):
+    import daemon_client
+    from upnp import UPnp, PortMapping
+
+    # The daemon streams the mappings back as it fetches them
+    rows = daemon_client.stream('port list', router=router)
+    if rows is None:
+        UPnp.list_port_mappings(router_uuid=router, format=format)
+        return
+
+    portmaps = (PortMapping(**row) for row in rows)
+    try:
+        if format == 'table':
+            UPnp.print_port_mappings(portmaps)
+        else:
+            UPnp.write_port_mappings(portmaps, UPnp.port_mapping_writer(format))
+    except daemon_client.DaemonError as e:
+        print(e, file=sys.stdout if format == 'table' else sys.stderr)
+
+def port_show(router, public_port, protocol='TCP'):
+    portmaps = _daemon_request('port show', router=router, public_port=public_port, protocol=protocol)
+    if portmaps is False:
+        return
+
+    from upnp import UPnp, PortMapping
+
+    if portmaps is None:
+        UPnp.show_port_mapping(router_uuid=router, public_port=public_port, protocol=protocol)
+    elif portmaps:
+        UPnp.print_port_mappings([PortMapping(**portmaps[0])])
+    else:
+        print('Port %s/%s is not mapped' % (public_port, protocol.upper()))
+
+def port_apply(router, file):
+    from upnp import UPnp
+
+    changes = _load_manifest(file)
+    if changes is None:
+        return
+    if _daemon_results('port apply', router=router, changes=_changes_to_json(changes)):
+        return
+
+    results = UPnp.apply_port_mappings(router_uuid=router, changes=changes)
+    if results is not None:
+        _print_results(results)
+
+def port_sync(router, file, prune=False):
+    from upnp import UPnp
+
+    changes = _load_manifest(file)
+    if changes is None:
+        return
+    if _daemon_results('port sync', router=router, changes=_changes_to_json(changes), prune=bool(prune)):
+        return
+
+    results = UPnp.sync_port_mappings(router_uuid=router, changes=changes, prune=prune)
+    if results is None:
+        return
+
+    if len(results) > 0:
+        _print_results(results)
+    else:
+        print("Port mappings are already up to date!")
+
+def fleet_list(uuids=None, networks=None, types=None, refresh=False, max_concurrency=None, rate_limit=None, format='table'):
+    from upnp import UPnp
+
+    if format != 'table':
+        # One writer for every router, so CSV output has a single header
+        writer = UPnp.port_mapping_writer(format, with_router=True)
+        for result in _fleet_results('list_port_mappings', uuids, networks, types, refresh, max_concurrency, rate_limit, out=sys.stderr):
+            if result.success:
+                UPnp.write_port_mappings(result.value, writer, router=result.router)
+        return
+
+    for result in _fleet_results('list_port_mappings', uuids, networks, types, refresh, max_concurrency, rate_limit):
+        if result.success:
+            UPnp.print_port_mappings(result.value)
+
+def fleet_apply(file, uuids=None, networks=None, types=None, refresh=False, max_concurrency=None, rate_limit=None):
+    changes = _load_manifest(file)
+    if changes is None:
+        return
+
+    for result in _fleet_results('apply_port_mappings', uuids, networks, types, refresh, max_concurrency, rate_limit, changes):
+        if result.success:
+            _print_results(result.value)
+
+def fleet_sync(file, uuids=None, networks=None, types=None, refresh=False, max_concurrency=None, rate_limit=None, prune=False):
+    changes = _load_manifest(file)
+    if changes is None:
+        return
+
+    for result in _fleet_results('sync_port_mappings', uuids, networks, types, refresh, max_concurrency, rate_limit, changes, prune):
+        if not result.success:
+            continue
+        if len(result.value) > 0:
+            _print_results(result.value)
+        else:
+            print("Port mappings are already up to date!")
+
+def _fleet_results(operation, uuids, networks, types, refresh, max_concurrency, rate_limit, *args, out=sys.stdout):
+    """
+    Runs a Fleet operation on the matching routers, printing a heading for each router as it finishes.
+    With out=sys.stderr only failures are reported, there, keeping stdout for machine readable rows.
+    """
+    from fleet import Fleet
+    from session import SessionPool
+
+    if max_concurrency:
+        Fleet.max_concurrency = max_concurrency
+    if rate_limit:
+        SessionPool.configure(router_rate_limit=rate_limit)
+
+    routers = Fleet.routers(uuids=uuids, networks=networks, types=types, refresh=refresh)
+    if not routers:
+        print('No matching routers found', file=out)
+        return
+
+    for result in getattr(Fleet, operation)(routers, *args):
+        if out is sys.stdout:
+            print()
+            print('Router %s (%s)' % (result.router.uuid, result.router.ip))
+            if not result.success:
+                print('Failed: %s' % result.error)
+        elif not result.success:
+            print('Router %s (%s) failed: %s' % (result.router.uuid, result.router.ip, result.error), file=out)
+        yield result
+
+def daemon_start(socket=None):
+    from daemon import Daemon
+
+    Daemon(socket_path=socket).run()
+
+def daemon_metrics(format='table'):
+    snapshot = _daemon_request('metrics')
+    if snapshot is None:
+        print('No daemon is running')
+    elif snapshot is not False:
+        _print_metrics(snapshot, format, sys.stdout)
+
+def _daemon_request(command, **args):
+    """
+    Sends a command to the running daemon.
+    Returns:
+        The command's result, None if no daemon is running, or False if the daemon reported an
+        error (which has been printed).
+    """
+    import daemon_client
+    from metrics import Metrics
+
+    with Metrics.timer('daemon_request'):
+        response = daemon_client.request(command, **args)
+    if response is None:
+        return None
+    if not response['ok']:
+        print(response['error'])
+        return False
+    return response['result']
+
+def _daemon_results(command, **args):
+    """Runs a port command on the running daemon and prints its results. Returns False if there is no daemon."""
+    results = _daemon_request(command, **args)
+    if results is None:
+        return False
+    if results is False:
+        return True
+
+    from upnp import PortMapping, PortMappingResult
+
+    if len(results) > 0:
+        _print_results([PortMappingResult(action, PortMapping(**portmap), error) for action, portmap, error in results])
+    elif command == 'port sync':
+        print("Port mappings are already up to date!")
+    return True
+
+def _changes_to_json(changes):
+    return [[action, portmap.to_dict()] for action, portmap in changes]
+
+def _print_results(results):
+    template = "{0:10}{1:10}{2:30}{3:10}{4:40}"
+    print(template.format("ACTION", "PUBLIC", "PRIVATE", "PROTOCOL", "RESULT"))
+    for result in results:
+        portmap = result.portmap
+        print(template.format(
+            result.action,
+            str(portmap.public_port),
+            '{}:{}'.format(portmap.private_ip, portmap.private_port) if result.action == 'add' else '',
+            portmap.protocol,
+            'OK' if result.success else result.error
+        ))
+
+def _load_manifest(path):
+    """
+    Reads a port mapping manifest. The file holds a list of mappings, each like
+    {"action": "add", "protocol": "TCP", "public_port": 80, "private_ip": "10.0.0.2", "private_port": 8080}.
+    action defaults to add, protocol to TCP, public_port to private_port and lease_duration to 0.
+    Adds need a private_ip and private_port, deletes a public_port.
+    Returns:
+        List[Tuple[str, PortMapping]]: The changes, or None if the file could not be read or has an
+        invalid entry, which is reported before any change is made.
+    """
+    from upnp import PortMapping
+
+    yaml = None
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            print('Reading YAML manifests needs PyYAML, install it with: pip3 install --user pyyaml')
+            return None
+
+    parse_errors = (ValueError, yaml.YAMLError) if yaml else ValueError
+    try:
+        with open(path) as f:
+            entries = yaml.safe_load(f) if yaml else json.load(f)
+    except OSError as e:
+        print('Could not read the manifest "%s": %s' % (path, e.strerror or e))
+        return None
+    except parse_errors as e:
+        print('Could not parse the manifest "%s": %s' % (path, e))
+        return None
+
+    if not isinstance(entries, list):
+        print('Invalid manifest "%s": expected a list of port mappings' % path)
+        return None
+
+    changes = []
+    for number, entry in enumerate(entries, 1):
+        error = _manifest_entry_error(entry)
+        if error:
+            print('Invalid manifest "%s": entry %d %s' % (path, number, error))
+            return None
+
+        private_port = entry.get('private_port', 0)
+        portmap = PortMapping(
+            public_port=entry.get('public_port') or private_port,
+            protocol=entry.get('protocol', 'TCP'),
+            private_ip=entry.get('private_ip', ''),
+            private_port=private_port,
+            description=entry.get('description', ''),
+            lease_duration=entry.get('lease_duration', 0)
+        )
+        changes.append((entry.get('action', 'add'), portmap))
+
+    return changes
+
+def _manifest_entry_error(entry):
+    """Returns what is wrong with a manifest entry, or None if it can be applied."""
+    if not isinstance(entry, dict):
+        return 'is not a mapping'
+
+    action = entry.get('action', 'add')
+    if action not in ('add', 'delete'):
+        return 'has an unknown action "%s", expected add or delete' % action
+    if str(entry.get('protocol', 'TCP')).upper() not in ('TCP', 'UDP'):
+        return 'has an unknown protocol "%s", expected TCP or UDP' % entry.get('protocol')
+
+    for field in ('public_port', 'private_port', 'lease_duration'):
+        value = entry.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+            return 'has a %s that is not a number' % field
+    for field in ('public_port', 'private_port'):
+        if not 0 <= entry.get(field, 0) <= 65535:
+            return 'has a %s out of range' % field
+    if entry.get('lease_duration', 0) < 0:
+        return 'has a negative lease_duration'
+
+    if action == 'delete':
+        if not entry.get('public_port'):
+            return 'deletes a mapping without a public_port'
+        return None
+
+    if not entry.get('private_port'):
+        return 'adds a mapping without a private_port'
+    private_ip = entry.get('private_ip')
+    if not private_ip or not isinstance(private_ip, str):
+        return 'adds a mapping without a private_ip'
+    import ipaddress
+    try:
+        ipaddress.ip_address(private_ip)
+    except ValueError:
+        return 'has a private_ip that is not an IP address'
+    return None
+
+def _print_metrics(snapshot, format, out):
+    from metrics import Metrics
+
+    if format == 'json':
+        print(Metrics.to_json(snapshot), file=out)
+    elif format == 'prometheus':
+        print(Metrics.to_prometheus(snapshot), end='', file=out)
+    else:
+        Metrics.report(snapshot, out=out)
+
+def _add_timings_argument(_, **kwargs):
+    kwargs['arg_group'].add_argument(
+        '--timings', dest='_timings', nargs='?', const='table', choices=['table', 'json', 'prometheus'],
+        help="Print a breakdown of where the command spent its time to stderr, as a table (default), json or prometheus."
+    )
+
+def _enable_timings(cli_ctx, **kwargs):
+    timings = getattr(kwargs['args'], '_timings', None)
+    if not timings:
+        return
+
+    from metrics import Metrics
+    Metrics.enable()
+    cli_ctx.register_event(EVENT_CLI_POST_EXECUTE, lambda *_, **__: _print_metrics(Metrics.snapshot(), timings, sys.stderr))
 
 def main():
     mycli = CLI(cli_name='upnp', commands_loader_cls=CommandsLoader)
+    mycli.register_event(EVENT_PARSER_GLOBAL_CREATE, _add_timings_argument)
+    mycli.register_event(EVENT_INVOKER_POST_PARSE_ARGS, _enable_timings)
     exit_code = mycli.invoke(sys.argv[1:])
 
 if __name__ == '__main__':
     main()
 
 # Commands needed
-# main.py routers list
+# main.py routers list [--format table|jsonl|csv]
+# main.py router ip <router>
 #
-# main.py port list <-- not sure if this is possible
-# main.py port add <router> <protocol> <public-port> <private-ip> <private-port>
+# main.py port list <router> [--format table|jsonl|csv]
+# main.py port add <router> <protocol> <public-port> <private-ip> <private-port> [<lease-duration>]
 # main.py port delete <router> <protocol> <public-port>
+# main.py port show <router> <protocol> <public-port>
+# main.py port apply <router> <file>
+# main.py port sync <router> <file> [--prune]
+# main.py fleet list [--uuids <pattern>...] [--networks <cidr>...] [--types <type>...] [--format table|jsonl|csv]
+# main.py fleet apply <file> [filters]
+# main.py fleet sync <file> [filters] [--prune]
+# main.py daemon start [--socket <path>]
+# main.py daemon metrics [--format table|json|prometheus]
+#
+# Any command takes --timings [table|json|prometheus]
 
 # print(json.dumps([r.__dict__ for r in routers]))
\ No newline at end of file
@@ -0,0 +1,236 @@
+import sys
+import json
+import time
+import bisect
+import threading
+
+class Histogram:
+    """Counts observed values into cumulative buckets, as Prometheus histograms do."""
+
+    # Upper bounds in seconds, suited to LAN round trips up to slow discovery phases
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimates a quantile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts))
+        }
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        Metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Metrics:
+    """
+    Process wide counters and latency histograms for discovery and SOAP calls, labelled e.g. by
+    phase, router or action. Recording is a no-op until enable() is called, so instrumented code
+    costs next to nothing when nobody is looking.
+
+    Phases of discovery and port operations are timed into the phase_seconds histogram, see timer().
+    Collected metrics can be read with snapshot(), or exported with to_json() and to_prometheus().
+    """
+
+    enabled = False
+
+    # Prefix of the exported Prometheus metric names
+    namespace = 'upnp'
+
+    _counters = {}
+    _histograms = {}
+    _lock = threading.Lock()
+    _null_timer = _NullTimer()
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._counters = {}
+            cls._histograms = {}
+
+    @classmethod
+    def count(cls, name, value=1, **labels):
+        """Adds value to a counter."""
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            cls._counters[key] = cls._counters.get(key, 0) + value
+
+    @classmethod
+    def observe(cls, name, value, **labels):
+        """Records a value, usually a duration in seconds, in a histogram."""
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            histogram = cls._histograms.get(key)
+            if histogram is None:
+                histogram = cls._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @classmethod
+    def timer(cls, phase, **labels):
+        """
+        Returns a context manager timing its block into phase_seconds.
+            with Metrics.timer('description_parse'):
+                ...
+        """
+        if not cls.enabled:
+            return cls._null_timer
+        labels['phase'] = phase
+        return _Timer('phase_seconds', labels)
+
+    @classmethod
+    def snapshot(cls):
+        """
+        Returns:
+            dict: {"counters": [{"name", "labels", "value"}], "histograms": [{"name", "labels", "count",
+            "sum", "max", "buckets"}]}, sorted by name and labels.
+        """
+        with cls._lock:
+            counters = sorted(cls._counters.items())
+            histograms = sorted(cls._histograms.items(), key=lambda item: item[0])
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in counters
+                ],
+                'histograms': [
+                    dict({'name': name, 'labels': dict(labels)}, **histogram.to_dict())
+                    for (name, labels), histogram in histograms
+                ]
+            }
+
+    @classmethod
+    def to_json(cls, snapshot=None):
+        return json.dumps(snapshot or cls.snapshot(), indent=2)
+
+    @classmethod
+    def to_prometheus(cls, snapshot=None):
+        """Returns the metrics in the Prometheus text exposition format."""
+        snapshot = snapshot or cls.snapshot()
+        lines = []
+
+        declared = set()
+        for counter in snapshot['counters']:
+            name = '{}_{}_total'.format(cls.namespace, counter['name'])
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, _format_labels(counter['labels']), counter['value']))
+
+        for histogram in snapshot['histograms']:
+            name = '{}_{}'.format(cls.namespace, histogram['name'])
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                labels = dict(histogram['labels'], le=bound)
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(histogram['labels']), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, _format_labels(histogram['labels']), histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def report(cls, snapshot=None, out=sys.stderr):
+        """Prints a human readable timing breakdown: phases, then per router latencies, then counters."""
+        snapshot = snapshot or cls.snapshot()
+
+        template = "{0:45}{1:>8}{2:>12}{3:>10}{4:>10}{5:>10}"
+        print(file=out)
+        print(template.format("TIMING", "COUNT", "TOTAL (ms)", "P50 (ms)", "P95 (ms)", "MAX (ms)"), file=out)
+        for histogram in snapshot['histograms']:
+            labels = dict(histogram['labels'])
+            name = labels.pop('phase', None) or histogram['name']
+            if labels:
+                name += ' ' + ' '.join('{}={}'.format(k, v) for k, v in sorted(labels.items()))
+
+            h = Histogram()
+            h.counts = list(histogram['buckets'].values())
+            h.count, h.sum, h.max = histogram['count'], histogram['sum'], histogram['max']
+            print(template.format(
+                name,
+                h.count,
+                '%.1f' % (h.sum * 1000),
+                '%.1f' % (h.quantile(0.5) * 1000),
+                '%.1f' % (h.quantile(0.95) * 1000),
+                '%.1f' % (h.max * 1000)
+            ), file=out)
+
+        if snapshot['counters']:
+            print(file=out)
+            print("{0:45}{1:>8}".format("COUNTER", "VALUE"), file=out)
+            for counter in snapshot['counters']:
+                name = counter['name']
+                if counter['labels']:
+                    name += ' ' + ' '.join('{}={}'.format(k, v) for k, v in sorted(counter['labels'].items()))
+                print("{0:45}{1:>8}".format(name, counter['value']), file=out)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items())
+    )
+    return '{' + ','.join(escaped) + '}'
@@ -0,0 +1,44 @@
+import sys
+import csv
+import json
+
+class RowWriter:
+    """
+    Writes listing rows one at a time as JSON lines or CSV, flushing after each so whatever reads
+    the output can start on a row as soon as it is fetched. Nothing is buffered, so memory does not
+    grow with the number of rows.
+
+        writer = RowWriter('csv', ['public_port', 'protocol', 'private_ip'])
+        for portmap in UPnp.iter_port_mappings(router):
+            writer.write(portmap.to_dict())
+    """
+
+    formats = ('jsonl', 'csv')
+
+    def __init__(self, format, fields, out=None):
+        """
+        Args:
+            format (str): 'jsonl' or 'csv'.
+            fields (List[str]): The columns of the CSV header, and the keys written for each row.
+            out: The file to write to, stdout by default.
+        """
+        if format not in RowWriter.formats:
+            raise ValueError('Unknown output format "%s", expected one of %s' % (format, ', '.join(RowWriter.formats)))
+
+        out = out or sys.stdout
+        self.format = format
+        self.fields = fields
+        self.out = out
+        self._csv = None
+
+        if format == 'csv':
+            self._csv = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+            self._csv.writeheader()
+            out.flush()
+
+    def write(self, row):
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self.out.write(json.dumps({field: row.get(field) for field in self.fields}) + '\n')
+        self.out.flush()
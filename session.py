@@ -0,0 +1,336 @@
+import time
+import random
+import threading
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import Metrics
+
+class RateLimiter:
+    """Spaces calls to acquire() evenly so that at most rate_per_sec of them return per second."""
+
+    def __init__(self, rate_per_sec):
+        self.interval_secs = 1.0 / rate_per_sec
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval_secs
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RouterUnavailable(requests.ConnectionError):
+    """Raised instead of sending a request to a router whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a router after failure_threshold consecutive requests to it failed
+    to get any answer. Once reset_timeout_secs have passed one request is let through again: if it
+    succeeds the breaker closes, otherwise it stays open for another reset_timeout_secs.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout_secs):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_secs = reset_timeout_secs
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """Whether requests are currently being refused, not counting a due trial request."""
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout_secs
+
+    def allow(self):
+        """Returns whether a request may be sent now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.reset_timeout_secs:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    Metrics.count('circuit_opened')
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+class RouterSession(requests.Session):
+    """
+    A requests.Session for one router. Idempotent requests without an explicit timeout get one
+    adapted to how fast the router has been answering, and are retried with jittered backoff when
+    they get no answer or a transient error; other requests get timeout_secs and are sent once. A
+    circuit breaker fails requests straight away once the router has stopped answering. It
+    optionally limits the rate of requests to its router and how many requests are in flight
+    across all routers.
+    """
+
+    def __init__(self, timeout_secs, rate_limiter=None, in_flight=None, breaker=None):
+        super().__init__()
+        self.timeout_secs = timeout_secs
+        self.rate_limiter = rate_limiter
+        self.in_flight = in_flight
+        self.breaker = breaker
+
+        # Smoothed response time and its variation, as TCP estimates round trip times (RFC 6298)
+        self._srtt = None
+        self._rttvar = None
+        self._backoff = 1
+        self._latency_lock = threading.Lock()
+
+    @property
+    def adaptive_timeout_secs(self):
+        """The timeout for the next request: a few deviations above the usual response time, within bounds."""
+        if self._srtt is None:
+            return self.timeout_secs
+        timeout = max(self._srtt + 4 * self._rttvar, SessionPool.min_timeout_secs) * self._backoff
+        return min(timeout, self.timeout_secs)
+
+    def request(self, method, url, idempotent=None, transient=None, **kwargs):
+        """
+        An explicit timeout bounds the whole request, retries included, so a caller waiting on a
+        router that stopped answering waits for that long once rather than once per attempt.
+
+        Args:
+            idempotent (bool): Whether the request may be sent again if it fails, by default only
+                for GET and HEAD requests.
+            transient (Callable[[requests.Response], bool]): Tells whether an error response is
+                worth retrying, by default 502, 503 and 504 responses are.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        attempts = SessionPool.max_attempts if idempotent else 1
+        transient = transient or _is_transient_status
+
+        if self.breaker is not None and not self.breaker.allow():
+            raise RouterUnavailable('%s is not answering, not retrying for a while' % urlsplit(url).netloc)
+
+        deadline = None
+        if isinstance(kwargs.get('timeout'), (int, float)):
+            deadline = time.monotonic() + kwargs['timeout']
+
+        for attempt in range(attempts):
+            if deadline is not None:
+                # urllib3 retries failed connections within an attempt, so split the connect
+                # timeout between its tries
+                remaining = max(deadline - time.monotonic(), 0.001)
+                kwargs['timeout'] = (remaining / (SessionPool.retries + 1), remaining)
+
+            error = None
+            try:
+                response = self._send(method, url, idempotent, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, e
+            else:
+                if response.status_code < 500 or not transient(response):
+                    return response
+
+            delay = SessionPool.retry_delay(attempt)
+            out_of_time = deadline is not None \
+                and deadline - time.monotonic() - delay < SessionPool.min_timeout_secs
+            if attempt + 1 == attempts or out_of_time:
+                if error is None:
+                    return response
+                # One failure per request however many attempts it took, see CircuitBreaker
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                raise error
+
+            if response is not None:
+                response.close()
+            Metrics.count('request_retries', method=method.upper())
+            time.sleep(delay)
+
+    def _send(self, method, url, idempotent, **kwargs):
+        # Writes aren't retried and may be slow to commit on the router, so only reads, which are
+        # retried after a timeout, get the adaptive timeout
+        adaptive = idempotent and 'timeout' not in kwargs
+        kwargs.setdefault('timeout', self.adaptive_timeout_secs if idempotent else self.timeout_secs)
+
+        if self.rate_limiter is not None:
+            with Metrics.timer('http_rate_limit_wait'):
+                self.rate_limiter.acquire()
+
+        start = time.perf_counter()
+        try:
+            if self.in_flight is None:
+                response = super().request(method, url, **kwargs)
+            else:
+                with Metrics.timer('http_in_flight_wait'):
+                    self.in_flight.acquire()
+                try:
+                    response = super().request(method, url, **kwargs)
+                finally:
+                    self.in_flight.release()
+        except requests.Timeout:
+            Metrics.count('http_timeouts')
+            if adaptive:
+                self._back_off_timeout()
+            raise
+
+        # The router answered, whatever it said
+        self._observe_latency(time.perf_counter() - start)
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+        # Connection attempts retried by urllib3 before the request got through
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            Metrics.count('http_retries', len(retries.history))
+        return response
+
+    def _observe_latency(self, secs):
+        with self._latency_lock:
+            self._backoff = 1
+            if self._srtt is None:
+                self._srtt = secs
+                self._rttvar = secs / 2
+            else:
+                self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - secs)
+                self._srtt = 0.875 * self._srtt + 0.125 * secs
+
+    def _back_off_timeout(self):
+        # A timed out request only says the router is slower than expected, so allow twice as long
+        # until it answers again (Karn's algorithm), up to timeout_secs
+        with self._latency_lock:
+            if self._srtt is not None and self.adaptive_timeout_secs < self.timeout_secs:
+                self._backoff *= 2
+
+
+def _is_transient_status(response):
+    return response.status_code in (502, 503, 504)
+
+
+class SessionPool:
+    """
+    Keeps one keep-alive requests.Session per router, keyed by its base URL, so that every SOAP
+    action and description fetch against the same router reuses already open connections.
+    """
+
+    # Maximum number of open connections kept per router
+    pool_size = 8
+    timeout_secs = 5
+    # Retries only cover failing to connect, when the request has not reached the router yet
+    retries = 2
+    backoff_factor = 0.2
+    # Maximum number of requests sent to each router per second, None for no limit
+    router_rate_limit = None
+    # Maximum number of requests in flight across all routers, None for no limit
+    max_in_flight = None
+    # Lower bound of the adaptive timeouts, timeout_secs being the upper bound
+    min_timeout_secs = 1
+    # Times an idempotent request is sent before giving up, and the backoff between attempts
+    max_attempts = 3
+    retry_backoff_secs = 0.1
+    max_retry_backoff_secs = 2
+    # Consecutive unanswered requests before a router is skipped, and for how long it is skipped
+    breaker_failure_threshold = 5
+    breaker_reset_timeout_secs = 30
+
+    _sessions = {}
+    _breakers = {}
+    _lock = threading.Lock()
+    _in_flight = None
+
+    @classmethod
+    def configure(cls, pool_size=None, timeout_secs=None, retries=None, backoff_factor=None,
+                  router_rate_limit=None, max_in_flight=None):
+        """Changes the pool settings. Sessions that are already open are closed and recreated on demand."""
+        if pool_size is not None:
+            cls.pool_size = pool_size
+        if timeout_secs is not None:
+            cls.timeout_secs = timeout_secs
+        if retries is not None:
+            cls.retries = retries
+        if backoff_factor is not None:
+            cls.backoff_factor = backoff_factor
+        if router_rate_limit is not None:
+            cls.router_rate_limit = router_rate_limit
+        if max_in_flight is not None:
+            cls.max_in_flight = max_in_flight
+        cls.close_all()
+
+    @classmethod
+    def get(cls, base_url):
+        """
+        Args:
+            base_url (str): The router's base URL, e.g. http://192.168.1.1:5000.
+        Returns:
+            requests.Session: The shared session for that router.
+        """
+        with cls._lock:
+            session = cls._sessions.get(base_url)
+            if session is None:
+                session = cls._create_session(base_url)
+                cls._sessions[base_url] = session
+            return session
+
+    @classmethod
+    def get_for_url(cls, url):
+        """Returns the shared session for the router serving the given URL."""
+        urlparts = urlsplit(url)
+        return cls.get('{}://{}'.format(urlparts.scheme, urlparts.netloc))
+
+    @classmethod
+    def is_available(cls, base_url):
+        """Returns False while the circuit breaker of the router at base_url is refusing requests."""
+        breaker = cls._breakers.get(base_url)
+        return breaker is None or not breaker.is_open
+
+    @classmethod
+    def retry_delay(cls, attempt):
+        """Returns how long to wait before retrying after the given attempt (counting from 0), with full jitter."""
+        return random.uniform(0, min(cls.retry_backoff_secs * 2 ** attempt, cls.max_retry_backoff_secs))
+
+    @classmethod
+    def close_all(cls):
+        """Closes every pooled session and its connections."""
+        with cls._lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
+            cls._in_flight = None
+
+    @classmethod
+    def _create_session(cls, base_url):
+        retry = Retry(
+            total=cls.retries,
+            connect=cls.retries,
+            read=0,
+            status=0,
+            backoff_factor=cls.backoff_factor
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.pool_size, max_retries=retry)
+
+        # Called with the pool lock held, all sessions share one in-flight limit
+        if cls.max_in_flight and cls._in_flight is None:
+            cls._in_flight = threading.BoundedSemaphore(cls.max_in_flight)
+        rate_limiter = RateLimiter(cls.router_rate_limit) if cls.router_rate_limit else None
+
+        # Breakers outlive sessions, so reconfiguring the pool doesn't forget which routers are down
+        breaker = cls._breakers.get(base_url)
+        if breaker is None:
+            breaker = cls._breakers[base_url] = CircuitBreaker(cls.breaker_failure_threshold, cls.breaker_reset_timeout_secs)
+
+        session = RouterSession(cls.timeout_secs, rate_limiter, cls._in_flight, breaker)
+        session.mount(base_url, adapter)
+        return session
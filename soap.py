@@ -0,0 +1,269 @@
+from xml.parsers import expat
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+SOAP_ENVELOPE_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+# The input arguments of each WANIPConnection/WANPPPConnection action, in the order the service
+# SCPDs of the IGD specifications declare them. Routers may reject arguments sent out of order.
+ACTION_ARGUMENTS = {
+    'GetExternalIPAddress': (),
+    'GetStatusInfo': (),
+    'GetConnectionTypeInfo': (),
+    'GetGenericPortMappingEntry': ('NewPortMappingIndex',),
+    'GetSpecificPortMappingEntry': ('NewRemoteHost', 'NewExternalPort', 'NewProtocol'),
+    'AddPortMapping': (
+        'NewRemoteHost', 'NewExternalPort', 'NewProtocol', 'NewInternalPort', 'NewInternalClient',
+        'NewEnabled', 'NewPortMappingDescription', 'NewLeaseDuration'
+    ),
+    'DeletePortMapping': ('NewRemoteHost', 'NewExternalPort', 'NewProtocol'),
+    # WANIPConnection:2 only
+    'AddAnyPortMapping': (
+        'NewRemoteHost', 'NewExternalPort', 'NewProtocol', 'NewInternalPort', 'NewInternalClient',
+        'NewEnabled', 'NewPortMappingDescription', 'NewLeaseDuration'
+    ),
+    'DeletePortMappingRange': ('NewStartPort', 'NewEndPort', 'NewProtocol', 'NewManage'),
+    'GetListOfPortMappings': ('NewStartPort', 'NewEndPort', 'NewProtocol', 'NewManage', 'NewNumberOfPorts'),
+}
+
+_envelope_start = (
+    '<?xml version="1.0"?>'
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+)
+_envelope_end = '</s:Body></s:Envelope>'
+
+# (service type, action) -> (prefix, ((argument name, opening tag, closing tag), ...), suffix), tags as bytes
+_envelope_parts = {}
+
+def build_request(service_type, action, arguments):
+    """
+    Builds the body of a SOAP action request. The envelope around the arguments is built once per
+    service type and action, and only the argument values are escaped and encoded on each call.
+    Args:
+        service_type (str): The router's service type, the namespace of the action.
+        action (str): The action name, one of ACTION_ARGUMENTS.
+        arguments (dict): Argument values by name. Missing arguments are sent empty, ints as
+            decimals and bools as 1 or 0.
+    Returns:
+        bytes: The request body.
+    """
+    parts = _envelope_parts.get((service_type, action))
+    if parts is None:
+        parts = _envelope_parts[(service_type, action)] = _build_envelope_parts(service_type, action)
+    prefix, tags, suffix = parts
+
+    body = [prefix]
+    for name, opening, closing in tags:
+        body.append(opening)
+        body.append(_encode_argument(arguments.get(name)))
+        body.append(closing)
+    body.append(suffix)
+    return b''.join(body)
+
+def _build_envelope_parts(service_type, action):
+    try:
+        names = ACTION_ARGUMENTS[action]
+    except KeyError:
+        raise ValueError('Unknown SOAP action "%s"' % action)
+
+    prefix = '{}<u:{} xmlns:u="{}">'.format(_envelope_start, action, escape(service_type, {'"': '&quot;'}))
+    suffix = '</u:{}>{}'.format(action, _envelope_end)
+    tags = tuple((name, '<{}>'.format(name).encode(), '</{}>'.format(name).encode()) for name in names)
+    return (prefix.encode(), tags, suffix.encode())
+
+def _encode_argument(value):
+    if value is None:
+        return b''
+    if isinstance(value, bool):
+        return b'1' if value else b'0'
+    if isinstance(value, int):
+        return str(value).encode()
+    return escape(value).encode('utf-8')
+
+class SOAPFault(Exception):
+    """A SOAP fault returned by a router, carrying the UPnP error code and description."""
+
+    def __init__(self, code, description=''):
+        super().__init__('UPnP error code %s%s' % (code, ': ' + description if description else ''))
+        self.code = code
+        self.description = description
+
+
+class SOAPResponseParser:
+    """
+    Incremental parser for the response to a SOAP action. It is fed the raw response bytes in as
+    many chunks as they arrive and never builds a tree of the envelope:
+
+    - The action's response element is matched by namespace and name, wherever it sits in the body.
+    - A fault is recognised from its elements as they stream past and raised from close().
+    - The text of stream_argument, an argument holding an escaped XML document such as the
+      NewPortListing of GetListOfPortMappings, is parsed as it arrives. Each child element of that
+      document is handed out by read_entries() once complete and then discarded, so memory stays
+      flat however large the document is.
+    """
+
+    def __init__(self, service_type, action, stream_argument=None):
+        self.service_type = service_type
+        self.action = action
+        self.stream_argument = stream_argument
+
+        self.arguments = {}
+        self.matched = False
+
+        self._response_tag = '{}}}{}Response'.format(service_type, action)
+        self._depth = 0
+        self._response_depth = None
+        self._argument = None
+        self._text = []
+
+        self._in_fault = False
+        self._fault_code = None
+        self._fault_description = ''
+
+        self._entries = []
+        self._listing = None
+        self._listing_root = None
+        self._listing_depth = 0
+
+        self._parser = expat.ParserCreate(namespace_separator='}')
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+
+    def feed(self, data):
+        """Parses the next chunk of the response body (bytes)."""
+        try:
+            self._parser.Parse(data, False)
+        except expat.ExpatError as e:
+            raise ElementTree.ParseError(str(e))
+
+    def close(self):
+        """
+        Finishes parsing.
+        Returns:
+            Dict[str, str]: The response's output arguments, or None if the body held no response to
+            the action.
+        Raises:
+            SOAPFault: If the router answered with a fault.
+            ElementTree.ParseError: If the body is not well formed XML.
+        """
+        try:
+            self._parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            raise ElementTree.ParseError(str(e))
+
+        if self._fault_code is not None:
+            raise SOAPFault(self._fault_code, self._fault_description)
+
+        return self.arguments if self.matched else None
+
+    def read_entries(self):
+        """Returns, and forgets, the stream_argument entries completed so far as Elements."""
+        entries = self._entries
+        self._entries = []
+        return entries
+
+    def _start(self, tag, attributes):
+        self._depth += 1
+
+        if self._argument == self.stream_argument and self._listing is not None:
+            return
+
+        local = tag.rsplit('}', 1)[-1]
+        if tag == SOAP_ENVELOPE_NS + '}Fault':
+            self._in_fault = True
+        elif self._in_fault and local in ('errorCode', 'errorDescription'):
+            self._argument = local
+            self._text = []
+        elif tag == self._response_tag:
+            self.matched = True
+            self._response_depth = self._depth
+        elif self._response_depth is not None and self._depth == self._response_depth + 1:
+            self._argument = local
+            self._text = []
+            if local == self.stream_argument:
+                self._listing = ElementTree.XMLPullParser(events=('start', 'end'))
+
+    def _end(self, tag):
+        depth = self._depth
+        self._depth -= 1
+
+        if self._argument is None:
+            if tag == SOAP_ENVELOPE_NS + '}Fault':
+                self._in_fault = False
+            elif depth == self._response_depth:
+                self._response_depth = None
+            return
+
+        if self._in_fault:
+            text = ''.join(self._text).strip()
+            if self._argument == 'errorCode':
+                try:
+                    self._fault_code = int(text)
+                except ValueError:
+                    self._fault_code = text
+            else:
+                self._fault_description = text
+        elif self._response_depth is not None and depth == self._response_depth + 1:
+            if self._argument == self.stream_argument and self._listing is not None:
+                self._listing.close()
+                self._read_listing()
+                self._listing = None
+            else:
+                self.arguments[self._argument] = ''.join(self._text)
+        else:
+            return
+
+        self._argument = None
+        self._text = []
+
+    def _data(self, data):
+        if self._argument is None:
+            return
+
+        if self._argument == self.stream_argument and self._listing is not None:
+            self._listing.feed(data)
+            self._read_listing()
+        else:
+            self._text.append(data)
+
+    def _read_listing(self):
+        for event, element in self._listing.read_events():
+            if event == 'start':
+                self._listing_depth += 1
+                if self._listing_root is None:
+                    self._listing_root = element
+            else:
+                self._listing_depth -= 1
+                if self._listing_depth == 1:
+                    # A complete entry of the listing, hand it out and drop it from the tree
+                    self._entries.append(element)
+                    self._listing_root.remove(element)
+
+
+def parse_response(content, service_type, action, stream_argument=None):
+    """
+    Parses a complete SOAP action response body, see SOAPResponseParser.
+    Returns:
+        Tuple[Dict[str, str], List[Element]]: The output arguments, or None if the body held no
+        response to the action, and the stream_argument entries.
+    """
+    parser = SOAPResponseParser(service_type, action, stream_argument)
+    parser.feed(content if isinstance(content, bytes) else content.encode('utf-8'))
+    arguments = parser.close()
+    return (arguments, parser.read_entries())
+
+
+def parse_fault(content):
+    """Returns the SOAPFault in a response body, or None if it does not hold one or isn't XML."""
+    parser = SOAPResponseParser('', '')
+    try:
+        parser.feed(content if isinstance(content, bytes) else content.encode('utf-8'))
+        parser.close()
+    except ElementTree.ParseError:
+        return None
+    except SOAPFault as fault:
+        return fault
+    return None
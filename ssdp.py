@@ -1,22 +1,33 @@
+import sys
 import time
 import select
 import socket
-import requests
-import email.parser
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as et
 from urllib.parse import urlsplit
-from fcache.cache import FileCache
+from cache import RouterCache
+from metrics import Metrics
 
 # Uses the ssdp project on GitHub as a reference
 # https://github.com/codingjoe/ssdp
 
 class Router:
-    def __init__(self, url, ip, port, wan_ip_type, base_url):
+    __slots__ = ('url', 'ip', 'port', 'type', 'base_url', 'usn', 'interface', 'max_age',
+                 'serial_number', 'uuid', 'control_url')
+
+    # Attributes saved in cache records, see to_record
+    _record_fields = __slots__
+
+    def __init__(self, url, ip, port, wan_ip_type, base_url, usn='', interface='', max_age=None):
         self.url = url
         self.ip = ip
         self.port = port
-        self.type = wan_ip_type
+        self.type = sys.intern(wan_ip_type)
         self.base_url = base_url
+        self.usn = usn
+        self.interface = interface
+        self.max_age = max_age
         self.serial_number = ""
         self.uuid = ""
         self.control_url = ""
@@ -27,10 +38,33 @@ class Router:
 
         if 'LOCATION' not in response_headers:
             print('The M-SEARCH response from %s:%d did not contain a Location header.' \
-                  % (sender[0], sender[1]))
-            print(ssdp_response)
+                  % (sender[0], sender[1]), file=sys.stderr)
+            print(ssdp_response, file=sys.stderr)
+            return None
+
+        return Router.parse_ssdp_headers(response_headers, sender)
+
+    @classmethod
+    def parse_ssdp_datagram(cls, buffer, sender, length=None):
+        """
+        Parses a router straight from a raw M-SEARCH response, see parse_ssdp_headers.
+        Returns:
+            Router: The router, or None if the datagram is not a successful response with a Location.
+        """
+        response_headers = parse_ssdp_headers(buffer, length)
+
+        if response_headers is None:
+            return None
+
+        if 'LOCATION' not in response_headers:
+            print('The M-SEARCH response from %s:%d did not contain a Location header.' \
+                  % (sender[0], sender[1]), file=sys.stderr)
             return None
 
+        return Router.parse_ssdp_headers(response_headers, sender)
+
+    @classmethod
+    def parse_ssdp_headers(cls, response_headers, sender):
         urlparts = urlsplit(response_headers['LOCATION'])
         base_url = '{}://{}'.format(urlparts.scheme, urlparts.netloc)
 
@@ -38,92 +72,700 @@ class Router:
             url=response_headers['LOCATION'],
             ip=sender[0],
             port=sender[1],
-            wan_ip_type=response_headers['ST'],
-            base_url=base_url
+            wan_ip_type=response_headers.get('ST', ''),
+            base_url=base_url,
+            usn=response_headers.get('USN', ''),
+            max_age=_parse_max_age(response_headers.get('CACHE-CONTROL', ''))
         )
 
+    def to_record(self):
+        """Returns the router as a plain dict, for caching."""
+        return {field: getattr(self, field) for field in Router._record_fields}
+
+    @classmethod
+    def from_record(cls, record):
+        router = Router(
+            url=record['url'],
+            ip=record['ip'],
+            port=record['port'],
+            wan_ip_type=record['type'],
+            base_url=record['base_url']
+        )
+        for field in Router._record_fields:
+            setattr(router, field, record.get(field, getattr(router, field)))
+        return router
+
+
+def _parse_max_age(cache_control):
+    """Returns the max-age of a CACHE-CONTROL header value in seconds, or None if it has none."""
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.strip().lower() == 'max-age':
+            try:
+                return int(value.strip().strip('"'))
+            except ValueError:
+                return None
+    return None
+
+
+# Headers parse_ssdp_headers extracts, by lower-cased name
+_ssdp_header_names = {
+    b'location': 'LOCATION',
+    b'st': 'ST',
+    b'usn': 'USN',
+    b'cache-control': 'CACHE-CONTROL',
+    b'nt': 'NT',
+    b'nts': 'NTS'
+}
+_ssdp_header_name_lengths = {len(name) for name in _ssdp_header_names}
+
+
+def parse_ssdp_headers(buffer, length=None):
+    """
+    Fast path for parsing M-SEARCH responses. Works directly on the received bytes, without decoding
+    the whole datagram, and only extracts the LOCATION, ST, USN and CACHE-CONTROL headers (and NT and
+    NTS for NOTIFYs), matching their names case-insensitively.
+    Args:
+        buffer (bytes or bytearray): The raw datagram, e.g. a buffer filled by recvfrom_into.
+        length (int): Number of valid bytes in the buffer, defaults to all of it.
+    Returns:
+        Dict[str, str]: The headers found, keyed by upper-case name, or None if the datagram is not
+        a 200 response.
+    """
+    if length is None:
+        length = len(buffer)
+
+    end = buffer.find(b'\n', 0, length)
+    if end < 0:
+        end = length
+    status_line = bytes(buffer[0:end]).split()
+    if len(status_line) < 2 or not status_line[0].startswith(b'HTTP/') or status_line[1] != b'200':
+        return None
+
+    return _parse_ssdp_header_lines(buffer, end + 1, length)
+
+
+def parse_ssdp_notify(buffer, length=None):
+    """
+    Parses an ssdp:alive or ssdp:byebye NOTIFY the same way parse_ssdp_headers parses responses.
+    Returns:
+        Dict[str, str]: The headers found, or None if the datagram is not a NOTIFY.
+    """
+    if length is None:
+        length = len(buffer)
+
+    end = buffer.find(b'\n', 0, length)
+    if end < 0:
+        end = length
+    if not buffer.startswith(b'NOTIFY ', 0, end):
+        return None
+
+    return _parse_ssdp_header_lines(buffer, end + 1, length)
+
+
+def _parse_ssdp_header_lines(buffer, pos, length):
+    headers = {}
+    while pos < length:
+        end = buffer.find(b'\n', pos, length)
+        if end < 0:
+            end = length
+
+        colon = buffer.find(b':', pos, end)
+        if colon < 0:
+            # A blank line ends the headers
+            if not bytes(buffer[pos:end]).strip():
+                break
+        elif colon - pos in _ssdp_header_name_lengths:
+            name = _ssdp_header_names.get(bytes(buffer[pos:colon]).lower())
+            if name:
+                headers[name] = bytes(buffer[colon + 1:end]).strip().decode('latin-1')
+
+        pos = end + 1
+
+    return headers
+
+
+class DiscoveryCondition:
+    """Decides when SSDP.list can stop waiting for more M-SEARCH responses."""
+
+    # Whether routers need their service description (and so their UUID) before is_met can judge them
+    needs_description = False
+
+    def is_met(self, routers, last_activity):
+        """
+        Args:
+            routers (List[Router]): Routers discovered so far.
+            last_activity (float): Time of the last request sent or response received.
+        Returns:
+            bool: True if discovery can stop.
+        """
+        raise NotImplementedError()
+
+
+class FirstRouter(DiscoveryCondition):
+    """Stops discovery as soon as any router responds."""
+
+    def is_met(self, routers, last_activity):
+        return len(routers) > 0
+
+
+class RouterUUID(DiscoveryCondition):
+    """Stops discovery once the router with the given UUID has been found."""
+
+    needs_description = True
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+    def is_met(self, routers, last_activity):
+        return any(r.uuid == self.uuid for r in routers)
+
+
+class QuietPeriod(DiscoveryCondition):
+    """Stops discovery once no new responses have arrived for the given number of milliseconds."""
+
+    def __init__(self, millis):
+        self.secs = millis / 1000
+
+    def is_met(self, routers, last_activity):
+        return time.time() - last_activity >= self.secs
+
 
 class SSDP:
     multicast_host = '239.255.255.250'
+    multicast_host_ipv6 = 'ff02::c'
     multicast_port = 1900
     buffer_size = 4096
     response_time_secs = 5
+    poll_interval_secs = 0.05
+    max_concurrent_fetches = 8
+    fetch_timeout_secs = 3
+
+    default_search_targets = [
+        'urn:schemas-upnp-org:service:WANIPConnection:1',
+        'urn:schemas-upnp-org:service:WANIPConnection:2'
+    ]
+    gateway_search_targets = default_search_targets + [
+        'urn:schemas-upnp-org:service:WANPPPConnection:1',
+        'urn:schemas-upnp-org:device:InternetGatewayDevice:1',
+        'urn:schemas-upnp-org:device:InternetGatewayDevice:2'
+    ]
+
+    @classmethod
+    def list(cls, refresh=False, until=None):
+        """
+        list finds all devices responding to an SSDP search for WANIPConnection:1 and WANIPConnection:2.
+        Args:
+            refresh (bool): Ignore the cached routers and search the network again.
+            until (DiscoveryCondition): Stop searching as soon as this condition is met instead of
+                waiting out the full response window. Routers found by a partial search are cached
+                individually, but do not count as a full search.
+        Returns:
+            List[Router]: The routers found.
+        """
+        cache = RouterCache()
+        try:
+            if not refresh:
+                routers = SSDP._read_cache(cache)
+                # The cached routers are the result of a search that went quiet when it finished
+                if routers is not None and (until is None or until.is_met(routers, cache.searched_at())):
+                    Metrics.count('ssdp_cache_hits')
+                    return routers
+
+            with Metrics.timer('ssdp_search'):
+                routers = SSDP._search(until)
+
+            if until is None:
+                cache.replace_all([(r.to_record(), r.max_age) for r in routers])
+            else:
+                for r in routers:
+                    cache.put(r.to_record(), r.max_age)
+        finally:
+            cache.close()
+
+        return routers
+
+    @classmethod
+    def iter_routers(cls, refresh=False):
+        """
+        Like list, but yields each router as soon as its service description has been fetched
+        rather than once the whole response window has passed. A fresh cache is yielded as is.
+        Routers are only cached once the search has run to the end.
+        Yields:
+            Router
+        """
+        cache = RouterCache()
+        try:
+            if not refresh:
+                routers = SSDP._read_cache(cache)
+                if routers is not None:
+                    Metrics.count('ssdp_cache_hits')
+                    yield from routers
+                    return
+
+            routers = []
+            for router in SSDP.iter_search():
+                routers.append(router)
+                yield router
+
+            cache.replace_all([(r.to_record(), r.max_age) for r in routers])
+        finally:
+            cache.close()
+
+    @classmethod
+    def iter_search(cls, interfaces=None, search_targets=None, ipv6=False):
+        """
+        Runs discover on a new event loop, yielding each router as soon as it has been described.
+        See discover for the arguments; like it, this neither reads nor updates the router cache.
+        """
+        import asyncio
+
+        print("Searching for routers. This can take a few seconds!", file=sys.stderr)
+        loop = asyncio.new_event_loop()
+        discovery = SSDP.discover(interfaces, search_targets, ipv6)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(discovery.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(discovery.aclose())
+            loop.close()
+
+    @classmethod
+    def _read_cache(cls, cache):
+        """Returns the cached routers, revalidating expired ones, or None if there is no fresh full search cached."""
+        with Metrics.timer('ssdp_cache_read'):
+            entries = cache.all()
+        if entries is None:
+            return None
+        with Metrics.timer('ssdp_cache_revalidate'):
+            return SSDP._revalidate_entries(cache, entries)
+
+    @classmethod
+    def find(cls, uuid):
+        """
+        Finds one router by UUID. A cached router is returned straight away, revalidating only that
+        router if its entry has expired; the network is only searched if it is not cached.
+        Returns:
+            Router: The router, or None if it could not be found.
+        """
+        cache = RouterCache()
+        try:
+            entry = cache.get(uuid)
+            if entry is not None:
+                routers = SSDP._revalidate_entries(cache, [entry])
+                if routers:
+                    return routers[0]
+        finally:
+            cache.close()
+
+        routers = SSDP.list(refresh=True, until=RouterUUID(uuid))
+        return next((r for r in routers if r.uuid == uuid), None)
+
+    @classmethod
+    def revalidate(cls, router):
+        """
+        Refetches a router's service description to check it is still there and unchanged.
+        Returns:
+            bool: True if the router answered with the same UUID. Its description is updated.
+        """
+        description = SSDP._fetch_description(router.url)
+        if description[1] != router.uuid:
+            return False
+
+        SSDP._describe_router(router, description)
+        return True
+
+    @classmethod
+    def refresh_cache(cls, within_secs=0):
+        """Revalidates the cached routers that have expired or will within the given number of seconds."""
+        cache = RouterCache()
+        try:
+            SSDP._revalidate_entries(cache, cache.all(margin_secs=within_secs) or [])
+        finally:
+            cache.close()
 
     @classmethod
-    def list(cls, refresh=False):
-        """list finds all devices responding to an SSDP search for WANIPConnection:1 and WANIPConnection:2."""
-        
-        # Open the file cache of objects
-        cache = FileCache("upnp", "cs")
-        
-        if cache and cache['lastUpdate'] and cache['routers']:
-            lastUpdate = cache['lastUpdate']
-            timeDelta = time.time() - lastUpdate
-
-            # Cache is recently refreshed in the last 5 minutes
-            if timeDelta < 300 and not refresh:
-                return cache['routers']
-
-        print("Searching for routers. This can take a few seconds!")
+    def start_background_refresh(cls, interval_secs=60):
+        """Starts a daemon thread that keeps the cached routers revalidated ahead of their expiry."""
+        def run():
+            while True:
+                time.sleep(interval_secs)
+                SSDP.refresh_cache(within_secs=interval_secs)
+
+        thread = threading.Thread(target=run, name='ssdp-cache-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    @classmethod
+    def _revalidate_entries(cls, cache, entries):
+        """Turns cache entries into routers, revalidating the expired ones concurrently and dropping those that fail."""
+        routers = [(Router.from_record(record), expired) for record, expired in entries]
+
+        def revalidate(router):
+            if SSDP.revalidate(router):
+                cache.put(router.to_record(), router.max_age)
+                return True
+            cache.remove(router.uuid)
+            return False
+
+        expired = [r for r, is_expired in routers if is_expired]
+        valid = set()
+        if expired:
+            with ThreadPoolExecutor(max_workers=SSDP.max_concurrent_fetches) as executor:
+                valid = {id(r) for r, ok in zip(expired, executor.map(revalidate, expired)) if ok}
+
+        return [r for r, is_expired in routers if not is_expired or id(r) in valid]
+
+    @classmethod
+    def _search(cls, until):
+        """Searches the network with M-SEARCH, see list."""
+        print("Searching for routers. This can take a few seconds!", file=sys.stderr)
 
         # Create a UDP socket and set its timeout
         sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM, proto=socket.IPPROTO_UDP)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
         sock.setblocking(False)
 
-        # Create the WANIPConnection:1 and WANIPConnection:2 request objects
-        headers = {
-            'HOST': "{}:{}".format(SSDP.multicast_host, SSDP.multicast_port),
-            'MAN': '"ssdp:discover"',
-            'MX': str(SSDP.response_time_secs),
-            'USER-AGENT': 'UPnP/x App/x Python/x'
-        }
-
-        wan_ip1_sent = False
-        wan_ip1 = SSDP._create_msearch_request('urn:schemas-upnp-org:service:WANIPConnection:1', headers=headers)
-
-        wan_ip2_sent = False
-        wan_ip2 = SSDP._create_msearch_request('urn:schemas-upnp-org:service:WANIPConnection:2', headers=headers)
+        pending_requests = SSDP._create_msearch_requests()
 
         inputs = [sock]
-        outputs = [sock]
-
-        routers = []
-        time_end = time.time() + SSDP.response_time_secs
+        # Responses are received into one reused buffer and parsed in place
+        buffer = bytearray(SSDP.buffer_size)
+
+        # Service descriptions are fetched concurrently as responses arrive, so the total time spent on
+        # them is roughly that of the slowest router rather than the sum over all routers. Gateways
+        # answer each M-SEARCH several times, so responses are deduplicated by USN and each description
+        # URL is fetched once and shared by every router pointing at it.
+        executor = ThreadPoolExecutor(max_workers=SSDP.max_concurrent_fetches)
+        seen = set()
+        descriptions = {}
+        fetches = []
+        stopped_early = False
+        last_activity = time.time()
+        time_end = last_activity + SSDP.response_time_secs
+
+        # Summed up locally and recorded once, to keep the loop cheap
+        select_secs = 0.0
+        parse_secs = 0.0
+        packets = 0
+        received_bytes = 0
+        duplicates = 0
 
         while time.time() < time_end:
-            _timeout = 1
+            # Only wait for writability while there are still requests to send, otherwise
+            # select returns immediately and the loop spins.
+            outputs = [sock] if pending_requests else []
+            _timeout = max(0, min(time_end - time.time(), SSDP.poll_interval_secs))
+            select_start = time.perf_counter()
             readable, writable, _ = select.select(inputs, outputs, inputs, _timeout)
+            select_secs += time.perf_counter() - select_start
             for _sock in readable:
-                msg, sender = _sock.recvfrom(SSDP.buffer_size)
-                response = SSDPResponse.parse(msg.decode())
-                router = Router.parse_ssdp_response(response, sender)
+                length, sender = _sock.recvfrom_into(buffer)
+                last_activity = time.time()
+                packets += 1
+                received_bytes += length
+
+                parse_start = time.perf_counter()
+                router = Router.parse_ssdp_datagram(buffer, sender, length)
+                parse_secs += time.perf_counter() - parse_start
                 if router:
-                    routers.append(router)
+                    key = SSDP._response_key(router)
+                    if key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(key)
+
+                    if router.url not in descriptions:
+                        descriptions[router.url] = executor.submit(SSDP._fetch_description, router.url)
+                    fetches.append((router, descriptions[router.url]))
 
             for _sock in writable:
-                if not wan_ip1_sent:
-                    wan_ip1.sendto(_sock, (SSDP.multicast_host, SSDP.multicast_port))
-                    time_end = time.time() + SSDP.response_time_secs
-                    wan_ip1_sent = True
-                if not wan_ip2_sent:
-                    wan_ip2.sendto(_sock, (SSDP.multicast_host, SSDP.multicast_port))
-                    time_end = time.time() + SSDP.response_time_secs
-                    wan_ip2_sent = True
-
-        for r in routers:
-            (serial_number, control_url, uuid) = SSDP._get_router_service_description(r.url)
-            r.serial_number = serial_number
-            r.control_url = control_url
-            r.uuid = uuid
-
-        # Update cache
-        cache['lastUpdate'] = time.time()
-        cache['routers'] = routers
-        cache.close()
+                while pending_requests:
+                    pending_requests.pop(0).sendto(_sock, (SSDP.multicast_host, SSDP.multicast_port))
+                    Metrics.count('ssdp_msearch_sent')
+                last_activity = time.time()
+                time_end = last_activity + SSDP.response_time_secs
+
+            if until is not None:
+                if until.needs_description:
+                    candidates = [SSDP._describe_router(r, f.result()) for r, f in fetches if f.done()]
+                else:
+                    candidates = [r for r, _ in fetches]
+                if until.is_met(candidates, last_activity):
+                    stopped_early = True
+                    break
+
+        sock.close()
+
+        Metrics.observe('phase_seconds', select_secs, phase='ssdp_select')
+        Metrics.observe('phase_seconds', parse_secs, phase='ssdp_parse')
+        Metrics.count('ssdp_packets_received', packets)
+        Metrics.count('ssdp_bytes_received', received_bytes)
+        Metrics.count('ssdp_duplicates', duplicates)
+
+        with Metrics.timer('ssdp_description_wait'):
+            if stopped_early and until.needs_description:
+                # The wanted router is already described, don't wait on the others
+                executor.shutdown(wait=False, cancel_futures=True)
+                fetches = [(r, f) for r, f in fetches if f.done() and not f.cancelled()]
+            else:
+                executor.shutdown(wait=True)
+
+        routers = []
+        described = set()
+        for r, f in fetches:
+            SSDP._describe_router(r, f.result())
+
+            # Responses to different search targets come from the same device, keep one router per
+            # device so it can be looked up by UUID
+            key = r.uuid or r.url
+            if key in described:
+                continue
+            described.add(key)
+            routers.append(r)
 
         return routers
 
+    @classmethod
+    def _fetch_description(cls, url):
+        """Fetches a service description, returning (None, None, []) if it can't be fetched or parsed."""
+        import requests
+
+        try:
+            return SSDP._get_router_service_description(url)
+        except (requests.RequestException, et.ParseError) as e:
+            print('Could not get the service description at "%s": %s' % (url, e), file=sys.stderr)
+            return (None, None, [])
+
+    @classmethod
+    def _describe_router(cls, router, description):
+        """
+        Fills in the serial number, control URL and UUID of a router from its service description.
+        The service matching the router's search target is used if there is one, otherwise the first
+        connection service, which is how routers found by their device type get a service type.
+        """
+        (serial_number, uuid, services) = description
+        router.serial_number = serial_number
+        router.uuid = uuid
+        router.control_url = None
+
+        service = next((svc for svc in services if svc[0] == router.type), None) \
+            or next(iter(services), None)
+        if service:
+            router.type = sys.intern(service[0])
+            router.control_url = service[1]
+        return router
+
+    @classmethod
+    async def discover(cls, interfaces=None, search_targets=None, ipv6=False):
+        """
+        Searches for routers on the running event loop, yielding each router as soon as its service
+        description has been fetched. Unlike list, this neither reads nor updates the router cache.
+
+            async for router in SSDP.discover(interfaces=['eth0', 'eth1'], ipv6=True):
+                ...
+
+        Args:
+            interfaces (List[str] or str): Interface names or local IPv4 addresses to search from, or
+                'all' for every non-loopback interface. By default the OS picks the interface.
+            search_targets (List[str]): Search targets (ST) to send, defaulting to WANIPConnection:1
+                and WANIPConnection:2. See SSDP.gateway_search_targets for the usual others.
+            ipv6 (bool): Also search the IPv6 link-local multicast group on each interface.
+        Yields:
+            Router: Each router found, with its serial number, control URL, UUID and the interface it
+            answered on filled in. Routers answering on several interfaces are only yielded once.
+        """
+        import asyncio
+        from ssdp_protocol import SSDPDiscoveryProtocol
+
+        loop = asyncio.get_running_loop()
+        found = asyncio.Queue()
+        search_targets = search_targets or SSDP.default_search_targets
+
+        transports = []
+        seen = set()
+        described = set()
+        descriptions = {}
+        describing = set()
+        next_router = None
+
+        async def describe(router):
+            SSDP._describe_router(router, await descriptions[router.url])
+            return router
+
+        try:
+            # Fan the M-SEARCHes out over every interface before waiting for any responses
+            for family, interface, local_addr, multicast_addr in SSDP._search_endpoints(interfaces, ipv6):
+                sock = SSDP._create_search_socket(family, local_addr)
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda interface=interface: SSDPDiscoveryProtocol(found, interface),
+                    sock=sock
+                )
+                transports.append(transport)
+
+                host = '[{}]'.format(multicast_addr[0]) if family == socket.AF_INET6 else multicast_addr[0]
+                for request in SSDP._create_msearch_requests(search_targets, host):
+                    request.sendto(transport, multicast_addr)
+                    Metrics.count('ssdp_msearch_sent')
+
+            time_end = loop.time() + SSDP.response_time_secs
+            next_router = loop.create_task(found.get())
+
+            while loop.time() < time_end or describing:
+                waiting = set(describing)
+                if loop.time() < time_end:
+                    waiting.add(next_router)
+
+                done, _ = await asyncio.wait(
+                    waiting,
+                    timeout=max(0, time_end - loop.time()) if next_router in waiting else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+
+                for task in done:
+                    if task is next_router:
+                        router = task.result()
+                        next_router = loop.create_task(found.get())
+
+                        key = SSDP._response_key(router)
+                        if key in seen:
+                            Metrics.count('ssdp_duplicates')
+                            continue
+                        seen.add(key)
+
+                        if router.url not in descriptions:
+                            descriptions[router.url] = loop.create_task(SSDP._fetch_description_async(router.url))
+                        describing.add(loop.create_task(describe(router)))
+                    else:
+                        describing.discard(task)
+                        router = task.result()
+
+                        # A device searched for by several targets, interfaces or address families
+                        # answers each of them, keep one router per device.
+                        key = router.uuid or router.url
+                        if key in described:
+                            continue
+                        described.add(key)
+                        yield router
+        finally:
+            # Also reached when the caller stops iterating early, so nothing is left pending
+            pending = [next_router] if next_router is not None else []
+            pending += list(describing) + list(descriptions.values())
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for transport in transports:
+                transport.close()
+
+    @classmethod
+    def search(cls, interfaces=None, search_targets=None, ipv6=False):
+        """Runs discover to completion on a new event loop and returns the routers it found."""
+        return list(SSDP.iter_search(interfaces, search_targets, ipv6))
+
+    @classmethod
+    def _search_endpoints(cls, interfaces, ipv6):
+        """
+        Works out where to send M-SEARCHes from.
+        Returns:
+            List[Tuple[int, str, str, Tuple]]: (address family, interface label, local address or
+            interface index to send from, multicast address) for each search socket.
+        """
+        v4_group = (SSDP.multicast_host, SSDP.multicast_port)
+
+        if not interfaces:
+            endpoints = [(socket.AF_INET, '', None, v4_group)]
+            if ipv6:
+                endpoints.append((socket.AF_INET6, '', 0, (SSDP.multicast_host_ipv6, SSDP.multicast_port, 0, 0)))
+            return endpoints
+
+        if interfaces == 'all':
+            interfaces = [name for _, name in socket.if_nameindex() if not name.startswith('lo')]
+
+        endpoints = []
+        for interface in interfaces:
+            if _is_ipv4_address(interface):
+                endpoints.append((socket.AF_INET, interface, interface, v4_group))
+                continue
+
+            address = _get_interface_ipv4_address(interface)
+            if address:
+                endpoints.append((socket.AF_INET, interface, address, v4_group))
+            if ipv6:
+                index = socket.if_nametoindex(interface)
+                endpoints.append(
+                    (socket.AF_INET6, interface, index, (SSDP.multicast_host_ipv6, SSDP.multicast_port, 0, index))
+                )
+
+        return endpoints
+
+    @classmethod
+    def _create_search_socket(cls, family, local_addr):
+        """Creates a non-blocking UDP socket that sends multicasts out of the given address or interface index."""
+        sock = socket.socket(family=family, type=socket.SOCK_DGRAM, proto=socket.IPPROTO_UDP)
+        sock.setblocking(False)
+
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, 2)
+            if local_addr:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, local_addr)
+        else:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            if local_addr:
+                sock.bind((local_addr, 0))
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(local_addr))
+
+        return sock
+
+    @classmethod
+    async def _fetch_description_async(cls, url):
+        """
+        Fetches a service description without blocking the event loop, like _fetch_description.
+        The request is made on its own connection with ssdp_protocol.http_get, so that discovery
+        doesn't import requests: it bypasses the SessionPool, and with it the router's retries and
+        circuit breaker. It is tried once, for at most fetch_timeout_secs.
+        """
+        import asyncio
+        from ssdp_protocol import http_get
+
+        try:
+            start = time.perf_counter()
+            xml_text = await asyncio.wait_for(http_get(url), SSDP.fetch_timeout_secs)
+            Metrics.observe('description_seconds', time.perf_counter() - start, router=urlsplit(url).netloc)
+            Metrics.count('description_bytes_received', len(xml_text))
+
+            with Metrics.timer('description_parse'):
+                return SSDP._parse_service_description(xml_text)
+        except asyncio.TimeoutError:
+            # Checked before OSError, which it is a subclass of from Python 3.11 on
+            error = 'no answer within %s seconds' % SSDP.fetch_timeout_secs
+        except (OSError, ValueError, et.ParseError) as e:
+            error = e
+        print('Could not get the service description at "%s": %s' % (url, error), file=sys.stderr)
+        return (None, None, [])
+
+    @classmethod
+    def _response_key(cls, router):
+        """Key used to recognise repeated M-SEARCH responses from the same device and service."""
+        return router.usn or (router.url, router.type)
+
+    @classmethod
+    def _create_msearch_requests(cls, search_targets=None, host=None):
+        """Creates an M-SEARCH request object for each search target, by default WANIPConnection:1 and :2."""
+        headers = {
+            'HOST': "{}:{}".format(host or SSDP.multicast_host, SSDP.multicast_port),
+            'MAN': '"ssdp:discover"',
+            'MX': str(SSDP.response_time_secs),
+            'USER-AGENT': 'UPnP/x App/x Python/x'
+        }
+
+        return [
+            SSDP._create_msearch_request(service_type, headers=dict(headers))
+            for service_type in search_targets or SSDP.default_search_targets
+        ]
+
     @classmethod
     def _create_msearch_request(cls, service_type, headers={}):
         headers["ST"] = service_type
@@ -132,11 +774,22 @@ class SSDP:
     @classmethod
     def _get_router_service_description(cls, url):
         """Examines the given router to find the control URL, serial number, and UUID."""
-        response = requests.get(url)
+        from session import SessionPool
+
+        start = time.perf_counter()
+        response = SessionPool.get_for_url(url).get(url, timeout=SSDP.fetch_timeout_secs)
+        Metrics.observe('description_seconds', time.perf_counter() - start, router=urlsplit(url).netloc)
+        Metrics.count('description_bytes_received', len(response.content))
         # print(response.text)
-        
+
+        with Metrics.timer('description_parse'):
+            return SSDP._parse_service_description(response.text)
+
+    @classmethod
+    def _parse_service_description(cls, xml_text):
+        """Finds the serial number, UUID, and the (service type, control URL) of each connection service."""
         # Parse the returned XML and find the <URLBase> and <controlURL> elements
-        xml = et.fromstring(response.text)
+        xml = et.fromstring(xml_text)
 
         serialNumber = next(
             (x.text for x in xml.findall(".//{urn:schemas-upnp-org:device-1-0}serialNumber")),
@@ -154,20 +807,49 @@ class SSDP:
         if uuid:
             uuid = uuid.split(":")[1]
 
+        services = []
         for svc in xml.findall(".//{urn:schemas-upnp-org:device-1-0}service"):
             svcType = svc.find(".//{urn:schemas-upnp-org:device-1-0}serviceType").text
             controlUrl = svc.find(".//{urn:schemas-upnp-org:device-1-0}controlURL").text
             # print("Found svcType:%s controlUrl:%s" % (svcType, controlUrl))
 
-            if (SSDP._is_wanip_service(svcType)):
-                return (serialNumber, controlUrl, uuid)
+            if (SSDP._is_connection_service(svcType)):
+                services.append((svcType, controlUrl))
 
-        return (None, None, None)
+        return (serialNumber, uuid, services)
 
     @classmethod
-    def _is_wanip_service(cls, svcType):
-        return svcType == "urn:schemas-upnp-org:service:WANIPConnection:1" \
-                    or svcType == "urn:schemas-upnp-org:service:WANIPConnection:2"
+    def _is_connection_service(cls, svcType):
+        return svcType in (
+            "urn:schemas-upnp-org:service:WANIPConnection:1",
+            "urn:schemas-upnp-org:service:WANIPConnection:2",
+            "urn:schemas-upnp-org:service:WANPPPConnection:1"
+        )
+
+def _is_ipv4_address(value):
+    try:
+        socket.inet_aton(value)
+        return value.count('.') == 3
+    except OSError:
+        return False
+
+
+def _get_interface_ipv4_address(name):
+    """Returns the IPv4 address of a network interface, or None if it has none or it can't be looked up."""
+    try:
+        import fcntl
+        import struct
+    except ImportError:
+        return None
+
+    SIOCGIFADDR = 0x8915
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            packed = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+        except OSError:
+            return None
+    return socket.inet_ntoa(packed[20:24])
+
 
 class SSDPMessage:
     """Simplified HTTP message to serve as a SSDP message."""
@@ -201,6 +883,8 @@ class SSDPMessage:
         Returns:
             (List[Tuple[str, str]): List of header tuples.
         """
+        import email.parser
+
         return list(email.parser.Parser().parsestr(msg).items())
 
     def __str__(self):
@@ -0,0 +1,48 @@
+import asyncio
+from urllib.parse import urlsplit
+from ssdp import Router
+from metrics import Metrics
+
+# The asyncio side of discovery lives here so that importing ssdp does not import asyncio.
+
+class SSDPDiscoveryProtocol(asyncio.DatagramProtocol):
+    """Parses M-SEARCH responses as they arrive and queues the routers they describe."""
+
+    def __init__(self, queue, interface=''):
+        self.queue = queue
+        self.interface = interface
+
+    def datagram_received(self, data, addr):
+        Metrics.count('ssdp_packets_received')
+        Metrics.count('ssdp_bytes_received', len(data))
+
+        router = Router.parse_ssdp_datagram(data, addr)
+        if router:
+            router.interface = self.interface
+            self.queue.put_nowait(router)
+
+    def error_received(self, exc):
+        print('SSDP discovery socket error: %s' % exc)
+
+
+async def http_get(url):
+    """Minimal HTTP/1.0 GET on asyncio streams, returning the body of a 200 response as bytes."""
+    urlparts = urlsplit(url)
+    port = urlparts.port or (443 if urlparts.scheme == 'https' else 80)
+    path = urlparts.path or '/'
+    if urlparts.query:
+        path += '?' + urlparts.query
+
+    reader, writer = await asyncio.open_connection(urlparts.hostname, port, ssl=urlparts.scheme == 'https')
+    try:
+        writer.write('GET {} HTTP/1.0\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(path, urlparts.netloc).encode())
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    status_line = head.split(b'\r\n', 1)[0].split()
+    if len(status_line) < 2 or status_line[1] != b'200':
+        raise ValueError('unexpected response "%s"' % head.split(b'\r\n', 1)[0].decode(errors='replace'))
+
+    return body
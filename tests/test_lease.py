@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# Keep the tests' router cache away from the user's
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='upnp-tests-')
+
+from fake_igd import FakeIGD
+from bench_igd import describe
+from lease import LeaseScheduler
+from upnp import PortMapping
+
+
+class LeaseSchedulerTest(unittest.TestCase):
+
+    def portmap(self, lease_duration):
+        return PortMapping(public_port=9000, protocol='TCP', private_ip='192.168.1.50', private_port=9000,
+                           lease_duration=lease_duration)
+
+    def test_short_lease_is_not_renewed_within_its_own_coalesce_window(self):
+        with FakeIGD() as igd:
+            router = describe(igd)
+            scheduler = LeaseScheduler()
+            scheduler.add(router, self.portmap(6), renew_in=0)
+            scheduler.start()
+            try:
+                time.sleep(2)
+            finally:
+                scheduler.stop()
+
+            # One renewal straight away, the next one not before 6 * 0.8 - 1.2 = 3.6 s later
+            self.assertEqual(igd.requests, 1)
+            self.assertEqual(len(scheduler), 1)
+            self.assertGreater(scheduler.next_due() - time.time(), 1)
+
+    def test_renewals_due_close_together_are_batched(self):
+        with FakeIGD() as igd:
+            router = describe(igd)
+            scheduler = LeaseScheduler()
+            now = time.time()
+            for port in (9000, 9001):
+                portmap = PortMapping(public_port=port, protocol='TCP', private_ip='192.168.1.50',
+                                      private_port=port, lease_duration=3600)
+                scheduler.add(router, portmap, renew_in=port - 9000)
+
+            results = scheduler.run_pending(now)
+            self.assertEqual([r.success for r in results], [True, True])
+
+    def test_only_permanent_leases_are_added_again_without_a_lease(self):
+        with FakeIGD(only_permanent_leases=True) as igd:
+            router = describe(igd)
+            scheduler = LeaseScheduler()
+            scheduler.add(router, self.portmap(3600), renew_in=0)
+
+            results = scheduler.run_pending()
+
+            self.assertEqual(results[0].fault_code, 725)
+            self.assertTrue(results[1].success)
+            self.assertEqual(results[1].portmap.lease_duration, 0)
+            self.assertEqual(igd.table[('', 9000, 'TCP')]['NewLeaseDuration'], '0')
+            self.assertEqual(len(scheduler), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import io
+import os
+import sys
+import json
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+
+
+class ManifestTest(unittest.TestCase):
+
+    def load(self, text, suffix='.json'):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            changes = main._load_manifest(path)
+        return changes, out.getvalue()
+
+    def test_valid_entries_are_loaded_with_defaults(self):
+        changes, _ = self.load(json.dumps([
+            {'private_ip': '10.0.0.2', 'private_port': 8080},
+            {'action': 'delete', 'protocol': 'udp', 'public_port': 27015}
+        ]))
+
+        self.assertEqual([(action, p.public_port, p.protocol) for action, p in changes],
+                         [('add', 8080, 'TCP'), ('delete', 27015, 'UDP')])
+
+    def test_malformed_entries_are_rejected_before_any_change(self):
+        for entry, error in [
+            ({'private_port': 80}, 'without a private_ip'),
+            ({'private_ip': '10.0.0.2'}, 'without a private_port'),
+            ({'action': 'delete'}, 'without a public_port'),
+            ({'private_ip': '10.0.0.2', 'private_port': '80'}, 'not a number'),
+            ({'private_ip': '10.0.0.2', 'private_port': 80, 'protocol': 'SCTP'}, 'unknown protocol'),
+        ]:
+            changes, out = self.load(json.dumps([{'private_ip': '10.0.0.3', 'private_port': 1}, entry]))
+            self.assertIsNone(changes)
+            self.assertIn('entry 2 ', out)
+            self.assertIn(error, out)
+
+    def test_missing_pyyaml_is_reported(self):
+        with mock.patch.dict(sys.modules, {'yaml': None}):
+            changes, out = self.load('- {private_ip: 10.0.0.2, private_port: 80}\n', suffix='.yaml')
+
+        self.assertIsNone(changes)
+        self.assertIn('needs PyYAML', out)
+
+
+if __name__ == '__main__':
+    unittest.main()
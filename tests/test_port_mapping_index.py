@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# Keep the tests' router cache away from the user's
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='upnp-tests-')
+
+from fake_igd import FakeIGD
+from bench_igd import describe
+from ssdp import SSDP
+from upnp import UPnp, PortMapping
+
+
+class PortMappingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('multicast_host', 'multicast_port', 'response_time_secs'):
+            self.addCleanup(setattr, SSDP, name, getattr(SSDP, name))
+
+        self.igd = FakeIGD(entries=10).start()
+        self.addCleanup(self.igd.stop)
+        SSDP.multicast_host, SSDP.multicast_port = self.igd.ssdp_address
+        SSDP.response_time_secs = 0.2
+
+        self.router = describe(self.igd)
+        UPnp._indexes.clear()
+        self.addCleanup(UPnp._indexes.clear)
+        self.addCleanup(setattr, UPnp, 'index_max_age_secs', UPnp.index_max_age_secs)
+
+    def test_public_add_and_delete_update_the_index(self):
+        UPnp.get_port_mappings(self.router)
+
+        UPnp.add_port_mapping(self.router.uuid, 'TCP', 9000, '10.0.0.9', 9000)
+        requests = self.igd.requests
+        self.assertEqual(UPnp.find_port_mapping(self.router, 9000, 'TCP').private_ip, '10.0.0.9')
+        self.assertEqual(self.igd.requests, requests)
+
+        UPnp.delete_port_mapping(self.router.uuid, 'TCP', 1024)
+        self.assertIsNone(UPnp.find_port_mapping(self.router, 1024, 'TCP'))
+        self.assertEqual(UPnp.find_port_mappings_for_host(self.router, '192.168.1.2'), [])
+
+    def test_apply_updates_the_index(self):
+        UPnp.get_port_mappings(self.router)
+        changes = [
+            ('add', PortMapping(public_port=1025, protocol='TCP', private_ip='10.0.0.9', private_port=1)),
+            ('delete', PortMapping(public_port=1026, protocol='TCP'))
+        ]
+        results = UPnp.apply_router_port_mappings(self.router, changes)
+        self.assertEqual([r.success for r in results], [False, True])
+
+        requests = self.igd.requests
+        self.assertIsNone(UPnp.find_port_mapping(self.router, 1026, 'TCP'))
+        self.assertEqual(self.igd.requests, requests)
+        # The conflicting add leaves the key unknown, so it is looked up again
+        self.assertEqual(UPnp.find_port_mapping(self.router, 1025, 'TCP').private_ip, '192.168.1.3')
+        self.assertEqual(self.igd.requests, requests + 1)
+
+    def test_mappings_are_not_trusted_past_max_age(self):
+        UPnp.index_max_age_secs = 0.1
+        self.assertIsNotNone(UPnp.find_port_mapping(self.router, 1024, 'TCP'))
+
+        # Another client deletes the mapping behind our back
+        del self.igd.table[('', 1024, 'TCP')]
+        self.igd._index = None
+        time.sleep(0.2)
+
+        self.assertIsNone(UPnp.find_port_mapping(self.router, 1024, 'TCP'))
+
+
+if __name__ == '__main__':
+    unittest.main()
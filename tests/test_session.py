@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import socket
+import threading
+import unittest
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from session import SessionPool
+
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        # A router that accepts connections and never answers
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(16)
+        self.addCleanup(self.server.close)
+        self.connections = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+        self.base_url = 'http://127.0.0.1:%d' % self.server.getsockname()[1]
+        self.addCleanup(SessionPool.close_all)
+        self.addCleanup(SessionPool._breakers.pop, self.base_url, None)
+
+    def _accept(self):
+        try:
+            while True:
+                self.connections.append(self.server.accept())
+        except OSError:
+            pass
+
+    def test_explicit_timeout_bounds_the_retries(self):
+        start = time.monotonic()
+        with self.assertRaises((requests.ConnectionError, requests.Timeout)):
+            SessionPool.get(self.base_url).get(self.base_url + '/desc.xml', timeout=1.5)
+
+        self.assertLess(time.monotonic() - start, 2.5)
+        self.assertEqual(SessionPool._breakers[self.base_url].failures, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import io
+import os
+import sys
+import socket
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# Keep the tests' router cache away from the user's
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='upnp-tests-')
+
+from fake_igd import FakeIGD
+from ssdp import SSDP
+
+
+class DiscoverTest(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('multicast_host', 'multicast_port', 'response_time_secs', 'fetch_timeout_secs'):
+            self.addCleanup(setattr, SSDP, name, getattr(SSDP, name))
+
+    def test_stopping_early_leaves_no_task_pending(self):
+        async def first_router():
+            discovery = SSDP.discover()
+            router = await discovery.__anext__()
+            await discovery.aclose()
+            return router, asyncio.all_tasks() - {asyncio.current_task()}
+
+        with FakeIGD() as igd:
+            SSDP.multicast_host, SSDP.multicast_port = igd.ssdp_address
+            SSDP.response_time_secs = 1
+            router, pending = asyncio.run(first_router())
+
+        self.assertEqual(router.uuid, igd.uuid)
+        self.assertEqual(pending, set())
+
+    def test_description_timeout_is_reported(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        SSDP.fetch_timeout_secs = 0.2
+
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            url = 'http://127.0.0.1:%d/desc.xml' % server.getsockname()[1]
+            result = asyncio.run(SSDP._fetch_description_async(url))
+
+        self.assertEqual(result, (None, None, []))
+        self.assertIn('no answer within 0.2 seconds', err.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# Keep the tests' router cache away from the user's
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='upnp-tests-')
+
+from fake_igd import FakeIGD
+from bench_igd import describe
+from upnp import UPnp, PortMapping
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.igd = FakeIGD(entries=3).start()
+        self.addCleanup(self.igd.stop)
+        self.router = describe(self.igd)
+        UPnp._indexes.clear()
+        self.addCleanup(UPnp._indexes.clear)
+
+    def test_explicit_deletes_are_not_deleted_again_when_pruning(self):
+        changes = [
+            ('delete', PortMapping(public_port=1025, protocol='TCP')),
+            ('add', PortMapping(public_port=1024, protocol='TCP', private_ip='192.168.1.2', private_port=1024))
+        ]
+        results = UPnp.sync_router_port_mappings(self.router, changes, prune=True)
+
+        self.assertEqual([(r.action, r.portmap.public_port) for r in results], [('delete', 1025), ('delete', 1026)])
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual(list(self.igd.table), [('', 1024, 'TCP')])
+
+    def test_a_mapping_deleted_and_added_again_is_deleted_once(self):
+        changes = [
+            ('delete', PortMapping(public_port=1024, protocol='TCP')),
+            ('add', PortMapping(public_port=1024, protocol='TCP', private_ip='192.168.1.2', private_port=1024))
+        ]
+        diff = UPnp.diff_port_mappings(UPnp.get_port_mappings(self.router), changes, prune=True)
+
+        self.assertEqual([(action, p.public_port) for action, p in diff],
+                         [('delete', 1024), ('add', 1024), ('delete', 1025), ('delete', 1026)])
+
+
+if __name__ == '__main__':
+    unittest.main()
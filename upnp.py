@@ -1,8 +1,26 @@
+import sys
+import time
+import threading
 import requests
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 from ssdp import SSDP, Router
+from session import SessionPool
+from metrics import Metrics
+from output import RowWriter
+from soap import SOAPFault, SOAPResponseParser, build_request, parse_response, parse_fault
 
 class PortMapping:
+    """
+    One port mapping. Ports and the lease duration are ints, is_enabled is a bool (None if unknown),
+    and the protocol and addresses are interned since they repeat across large tables.
+    """
+
+    __slots__ = ('remote_host', 'public_port', 'protocol', 'private_ip', 'private_port',
+                 'is_enabled', 'description', 'lease_duration')
+
     def __init__(self,
         remote_host = '*',
         public_port = 0,
@@ -13,15 +31,18 @@ class PortMapping:
         description = '',
         lease_duration = -1
     ):
-        self.remote_host = remote_host
-        self.public_port = public_port
-        self.protocol = protocol
-        self.private_ip = private_ip
-        self.private_port = private_port
+        self.remote_host = sys.intern(remote_host or '*')
+        self.public_port = int(public_port)
+        self.protocol = sys.intern(protocol.upper())
+        self.private_ip = sys.intern(private_ip)
+        self.private_port = int(private_port)
         self.is_enabled = is_enabled
         self.description = description
-        self.lease_duration = lease_duration
+        self.lease_duration = int(lease_duration)
     
+    def to_dict(self):
+        return {field: getattr(self, field) for field in PortMapping.__slots__}
+
     def __str__(self):
         return '%s %s %s %s %s %s %s %s' % (
             self.remote_host,
@@ -35,65 +56,290 @@ class PortMapping:
         )
 
     @classmethod
-    def parse_port_map_xml(cls, xml_text, router_type):
-        '''Parses a UPnP GetGenericPortMappingEntry xml response.'''
-        doc = ElementTree.fromstring(xml_text)
-        
-        generic_portmap_tag_text = f"{{{router_type}}}GetGenericPortMappingEntryResponse"
-
-        response_tag = doc[0][0]
-        # print(response_tag.tag)
-        if response_tag.tag == generic_portmap_tag_text:
-            remote_host = '*'
-            public_port = 0
-            protocol = ''
-            private_ip = ''
-            private_port = 0
-            is_enabled = None
-            description = ''
-            lease_duration = -1
-
-            for prop in response_tag:
-                # print(prop.tag, prop.text)
-                if prop.tag == 'NewRemoteHost':
-                    remote_host = prop.text if prop.text else '*'
-                elif prop.tag == 'NewExternalPort':
-                    public_port = prop.text if prop.text else 0
-                elif prop.tag == 'NewProtocol':
-                    protocol = prop.text if prop.text else '-'
-                elif prop.tag == 'NewInternalPort':
-                    private_port = prop.text if prop.text else 0
-                elif prop.tag == 'NewInternalClient':
-                    private_ip = prop.text if prop.text else '*'
-                elif prop.tag == 'NewEnabled':
-                    is_enabled = prop.text if prop.text else '-'
-                elif prop.tag == 'NewPortMappingDescription':
-                    description = prop.text if prop.text else 'None'
-                elif prop.tag == 'NewLeaseDuration':
-                    lease_duration = prop.text if prop.text else '-'
-            
-            return PortMapping(
-                remote_host=remote_host,
-                public_port=public_port,
-                protocol=protocol,
-                private_ip=private_ip,
-                private_port=private_port,
-                is_enabled=is_enabled,
-                description=description,
-                lease_duration=lease_duration
-            )
-        else:
-            return None
+    def _from_xml_properties(cls, element):
+        '''Builds a port mapping from the child elements of a mapping entry, ignoring their namespace.'''
+        return PortMapping._from_arguments((prop.tag, prop.text) for prop in element)
+
+    @classmethod
+    def _from_arguments(cls, arguments):
+        '''Builds a port mapping from (name, text) pairs, ignoring any namespace on the names.'''
+        remote_host = '*'
+        public_port = 0
+        protocol = ''
+        private_ip = ''
+        private_port = 0
+        is_enabled = None
+        description = ''
+        lease_duration = -1
+
+        for name, value in arguments:
+            # print(name, value)
+            tag = name.rsplit('}', 1)[-1]
+            text = value.strip() if value else ''
+            if tag == 'NewRemoteHost':
+                remote_host = text or '*'
+            elif tag == 'NewExternalPort':
+                public_port = _parse_int(text, 0)
+            elif tag == 'NewProtocol':
+                protocol = text
+            elif tag == 'NewInternalPort':
+                private_port = _parse_int(text, 0)
+            elif tag == 'NewInternalClient':
+                private_ip = text
+            elif tag == 'NewEnabled':
+                is_enabled = _parse_bool(text)
+            elif tag in ('NewPortMappingDescription', 'NewDescription'):
+                description = text
+            elif tag in ('NewLeaseDuration', 'NewLeaseTime'):
+                lease_duration = _parse_int(text, -1)
+
+        return PortMapping(
+            remote_host=remote_host,
+            public_port=public_port,
+            protocol=protocol,
+            private_ip=private_ip,
+            private_port=private_port,
+            is_enabled=is_enabled,
+            description=description,
+            lease_duration=lease_duration
+        )
+
+def _parse_int(text, default):
+    try:
+        return int(text)
+    except ValueError:
+        return default
+
+def _parse_bool(text):
+    '''Parses a UPnP boolean, returning None if it is missing or not one.'''
+    value = text.lower()
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    return None
+
+class PortMappingTable:
+    """
+    Column-oriented store for large port mapping listings. Numbers live in typed arrays and strings
+    are interned, which takes far less memory than one object per mapping and makes filtering and
+    sorting cheap. Rows are read back as PortMapping objects.
+    """
+
+    _protocols = ('', 'TCP', 'UDP')
+
+    def __init__(self):
+        self.remote_hosts = []
+        self.public_ports = array('H')
+        self.protocols = array('B')
+        self.private_ips = []
+        self.private_ports = array('H')
+        # -1 unknown, 0 disabled, 1 enabled
+        self.enabled = array('b')
+        self.descriptions = []
+        self.lease_durations = array('l')
+
+    @classmethod
+    def from_port_mappings(cls, portmaps):
+        table = PortMappingTable()
+        for portmap in portmaps:
+            table.append(portmap)
+        return table
+
+    def append(self, portmap):
+        protocol = portmap.protocol
+        self.remote_hosts.append(portmap.remote_host)
+        self.public_ports.append(portmap.public_port)
+        self.protocols.append(self._protocols.index(protocol) if protocol in self._protocols else 0)
+        self.private_ips.append(portmap.private_ip)
+        self.private_ports.append(portmap.private_port)
+        self.enabled.append(-1 if portmap.is_enabled is None else int(portmap.is_enabled))
+        self.descriptions.append(portmap.description)
+        self.lease_durations.append(portmap.lease_duration)
+
+    def __len__(self):
+        return len(self.public_ports)
+
+    def __getitem__(self, index):
+        enabled = self.enabled[index]
+        return PortMapping(
+            remote_host=self.remote_hosts[index],
+            public_port=self.public_ports[index],
+            protocol=self._protocols[self.protocols[index]],
+            private_ip=self.private_ips[index],
+            private_port=self.private_ports[index],
+            is_enabled=None if enabled < 0 else bool(enabled),
+            description=self.descriptions[index],
+            lease_duration=self.lease_durations[index]
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def select(self, indexes):
+        """Returns a new table holding the given rows, in the given order."""
+        table = PortMappingTable()
+        table.remote_hosts = [self.remote_hosts[i] for i in indexes]
+        table.public_ports = array('H', (self.public_ports[i] for i in indexes))
+        table.protocols = array('B', (self.protocols[i] for i in indexes))
+        table.private_ips = [self.private_ips[i] for i in indexes]
+        table.private_ports = array('H', (self.private_ports[i] for i in indexes))
+        table.enabled = array('b', (self.enabled[i] for i in indexes))
+        table.descriptions = [self.descriptions[i] for i in indexes]
+        table.lease_durations = array('l', (self.lease_durations[i] for i in indexes))
+        return table
+
+    def filter(self, protocol=None, private_ip=None, public_ports=None):
+        """
+        Returns a new table with the rows matching every given condition.
+        Args:
+            protocol (str): TCP or UDP.
+            private_ip (str): The internal client.
+            public_ports (range or Set[int]): Public ports to keep.
+        """
+        indexes = range(len(self))
+        if protocol is not None:
+            code = self._protocols.index(protocol.upper())
+            indexes = [i for i in indexes if self.protocols[i] == code]
+        if private_ip is not None:
+            indexes = [i for i in indexes if self.private_ips[i] == private_ip]
+        if public_ports is not None:
+            indexes = [i for i in indexes if self.public_ports[i] in public_ports]
+        return self.select(indexes)
+
+    def sort(self, column='public_ports', reverse=False):
+        """Returns a new table sorted by one of the column attributes, e.g. 'private_ports'."""
+        values = getattr(self, column)
+        return self.select(sorted(range(len(self)), key=values.__getitem__, reverse=reverse))
+
+class PortMappingIndex:
+    """
+    Local index of one router's port mappings, keyed by (public_port, protocol) and by private IP,
+    so checking a port or finding the mappings of a host never has to walk the router's table.
+
+    It is filled by full listings and lookups, and kept up to date by our own Add/Delete calls.
+    As other clients may change the router's table meanwhile, each mapping is only trusted for
+    max_age_secs after it was seen, and a missing key only means there is no such mapping while
+    the index is complete: for max_age_secs after a full listing. Keys whose state became unknown,
+    e.g. after a failed add, are never answered from the index.
+    """
+
+    def __init__(self, max_age_secs):
+        self.max_age_secs = max_age_secs
+        self._by_key = {}
+        self._by_private_ip = {}
+        self._unknown = set()
+        self._listed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def complete(self):
+        """True if the index holds every mapping on the router, as of a recent full listing."""
+        return self._listed_at is not None and time.time() - self._listed_at < self.max_age_secs
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def replace_all(self, portmaps):
+        """Replaces the index with the result of a full listing."""
+        now = time.time()
+        with self._lock:
+            self._by_key = {}
+            self._by_private_ip = {}
+            self._unknown = set()
+            for portmap in portmaps:
+                self._add(portmap, now)
+            self._listed_at = now
+
+    def add(self, portmap):
+        with self._lock:
+            self._remove((portmap.public_port, portmap.protocol))
+            self._add(portmap, time.time())
+
+    def remove(self, public_port, protocol):
+        with self._lock:
+            self._remove((public_port, protocol.upper()))
+
+    def forget(self, public_port, protocol):
+        """Marks a key as unknown, so it is looked up on the router again."""
+        with self._lock:
+            key = (public_port, protocol.upper())
+            self._remove(key)
+            self._unknown.add(key)
+
+    def lookup(self, public_port, protocol):
+        """
+        Returns:
+            Tuple[bool, PortMapping]: Whether the index knows the answer, and the mapping (None if
+            there is none).
+        """
+        key = (public_port, protocol.upper())
+        with self._lock:
+            entry = self._by_key.get(key)
+            if entry is not None:
+                portmap, seen_at = entry
+                return (time.time() - seen_at < self.max_age_secs, portmap)
+            return (key not in self._unknown and self.complete, None)
+
+    def for_private_ip(self, private_ip):
+        """Returns the indexed mappings pointing at a host."""
+        with self._lock:
+            return [self._by_key[key][0] for key in self._by_private_ip.get(private_ip, ())]
+
+    def _add(self, portmap, seen_at):
+        key = (portmap.public_port, portmap.protocol)
+        self._by_key[key] = (portmap, seen_at)
+        self._by_private_ip.setdefault(portmap.private_ip, set()).add(key)
+        self._unknown.discard(key)
+
+    def _remove(self, key):
+        entry = self._by_key.pop(key, None)
+        if entry is not None:
+            portmap = entry[0]
+            keys = self._by_private_ip.get(portmap.private_ip)
+            keys.discard(key)
+            if not keys:
+                del self._by_private_ip[portmap.private_ip]
+
+class PortMappingResult:
+    def __init__(self, action, portmap, error=None, fault_code=None):
+        self.action = action
+        self.portmap = portmap
+        self.error = error
+        # The UPnP error code when the router answered with a SOAP fault
+        self.fault_code = fault_code
+
+    @property
+    def success(self):
+        return self.error is None
 
 class UPnp:
 
-    _add_port_mapping_template = '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:AddPortMapping xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1"><NewExternalPort>{}</NewExternalPort><NewProtocol>{}</NewProtocol><NewInternalPort>{}</NewInternalPort><NewInternalClient>{}</NewInternalClient><NewEnabled>1</NewEnabled><NewPortMappingDescription>{}</NewPortMappingDescription><NewLeaseDuration>0</NewLeaseDuration></u:AddPortMapping></s:Body></s:Envelope>'
-    _delete_port_mapping_template = '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:DeletePortMapping xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1"><NewExternalPort>{}</NewExternalPort><NewProtocol>{}</NewProtocol></u:AddPortMapping></s:Body></s:Envelope>'
-    _list_port_mappings_template = '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetGenericPortMappingEntry xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1"><NewPortMappingIndex>{}</NewPortMappingIndex></u:GetGenericPortMappingEntry></s:Body></s:Envelope>'
+    _wanip2_service_type = 'urn:schemas-upnp-org:service:WANIPConnection:2'
+
+    # Number of GetGenericPortMappingEntry requests kept in flight while listing port mappings
+    enumeration_window = 8
+    # Number of concurrent Add/DeletePortMapping calls made by apply_port_mappings
+    batch_concurrency = 4
+    # Size of the chunks GetListOfPortMappings responses are parsed in
+    stream_chunk_size = 16384
+    # How long a full listing is trusted to hold every mapping on the router, see PortMappingIndex
+    index_max_age_secs = 60
+    # Actions that only read state, and so are retried if they fail transiently
+    idempotent_actions = frozenset([
+        'GetExternalIPAddress', 'GetStatusInfo', 'GetConnectionTypeInfo', 'GetGenericPortMappingEntry',
+        'GetSpecificPortMappingEntry', 'GetListOfPortMappings'
+    ])
+    # ActionFailed, which routers answer with when busy or briefly out of resources
+    _transient_fault_codes = frozenset([501])
+
+    _indexes = {}
+    _indexes_lock = threading.Lock()
 
     @classmethod
-    def add_port_mapping(cls, router_uuid, protocol, public_port, private_ip, private_port):
-        '''Adds a port mapping to a router'''
+    def add_port_mapping(cls, router_uuid, protocol, public_port, private_ip, private_port, lease_duration=0):
+        '''Adds a port mapping to a router. A lease_duration of 0 makes it permanent.'''
         print("Adding port mapping (%s, %s, %s, %s, %s)" \
                 % (router_uuid, protocol, public_port, private_ip, private_port))
 
@@ -106,22 +352,15 @@ class UPnp:
         url = '{}{}'.format(router.base_url, router.control_url)
         print('Adding port mapping (%s %s/%s) at url "%s"' % (private_ip, private_port, protocol, url))
 
-        headers = {
-            'Host': '{}:{}'.format(router.ip, router.port),
-            'Content-Type': 'text/xml; charset=utf-8',
-            'SOAPACTION': '{}#AddPortMapping'.format(router.type)
-        }
-
-        mapping_description = 'dave_upnp_{}:{}'.format(private_ip, private_port)
-        data = UPnp._add_port_mapping_template.format(
-            public_port,
-            protocol,
-            private_port,
-            private_ip,
-            mapping_description
+        portmap = PortMapping(
+            public_port=public_port,
+            protocol=protocol,
+            private_ip=private_ip,
+            private_port=private_port,
+            lease_duration=lease_duration
         )
 
-        response = requests.post(url, data=data, headers=headers)
+        response = UPnp._add_port_mapping(router, portmap)
         print(response.text)
     
     @classmethod
@@ -139,75 +378,608 @@ class UPnp:
         url = '{}{}'.format(router.base_url, router.control_url)
         print('Deleting port mapping (%s/%s) at url "%s"' % (public_port, protocol, url))
 
-        headers = {
-            'Host': '{}:{}'.format(router.ip, router.port),
-            'Content-Type': 'text/xml; charset=utf-8',
-            'SOAPACTION': '{}#DeletePortMapping'.format(router.type)
-        }
+        response = UPnp._delete_port_mapping(router, PortMapping(public_port=public_port, protocol=protocol))
+        print(response.text)
 
-        data = UPnp._delete_port_mapping_template.format(public_port, protocol)
+    @classmethod
+    def print_external_ip_address(cls, router_uuid):
+        '''Prints the public IP address of a router'''
+        router = UPnp._find_router(router_uuid)
 
-        response = requests.post(url, data=data, headers=headers)
-        print(response.text)
+        if not router:
+            print('No router found with uuid "%s"' % router_uuid)
+            return
+
+        try:
+            print(UPnp.get_external_ip_address(router) or 'The router has no external IP address')
+        except (SOAPFault, requests.RequestException, ElementTree.ParseError) as e:
+            print('Could not get the external IP address: %s' % e)
+
+    @classmethod
+    def show_port_mapping(cls, router_uuid, public_port, protocol):
+        '''Prints the mapping of one public port'''
+        router = UPnp._find_router(router_uuid)
+
+        if not router:
+            print('No router found with uuid "%s"' % router_uuid)
+            return
+
+        try:
+            portmap = UPnp.find_port_mapping(router, public_port, protocol)
+        except (SOAPFault, requests.RequestException, ElementTree.ParseError) as e:
+            print('Could not look up port %s/%s: %s' % (public_port, protocol, e))
+            return
+
+        if portmap is None:
+            print('Port %s/%s is not mapped' % (public_port, protocol.upper()))
+        else:
+            UPnp.print_port_mappings([portmap])
 
     @classmethod
-    def list_port_mappings(cls, router_uuid):
-        '''Lists the port mappings for a router'''
+    def apply_port_mappings(cls, router_uuid, changes):
+        '''
+        Adds and deletes many port mappings on one router. The router is looked up once and the SOAP
+        calls run concurrently over its pooled connections. Deletes are applied before adds.
+        Args:
+            router_uuid (str): The router's UUID.
+            changes (List[Tuple[str, PortMapping]]): ('add' or 'delete', port mapping) pairs.
+        Returns:
+            List[PortMappingResult]: One result per change, in the order given, or None if the
+            router was not found.
+        '''
+        router = UPnp._find_router(router_uuid)
+
+        if not router:
+            print('No router found with uuid "%s"' % router_uuid)
+            return None
 
+        return UPnp.apply_router_port_mappings(router, changes)
+
+    @classmethod
+    def sync_port_mappings(cls, router_uuid, changes, prune=False):
+        '''
+        Brings a router's port mappings to a desired state, only issuing the Add/Delete calls needed
+        to get there from its current table.
+        Args:
+            router_uuid (str): The router's UUID.
+            changes (List[Tuple[str, PortMapping]]): ('add', port mapping) pairs for mappings that
+                should exist and ('delete', port mapping) pairs for mappings that should not.
+            prune (bool): Also delete every current mapping that is not listed.
+        Returns:
+            List[PortMappingResult]: One result per call made, or None if the router was not found.
+        '''
         router = UPnp._find_router(router_uuid)
 
         if not router:
             print('No router found with uuid "%s"' % router_uuid)
+            return None
+
+        return UPnp.sync_router_port_mappings(router, changes, prune)
+
+    @classmethod
+    def sync_router_port_mappings(cls, router, changes, prune=False):
+        '''Like sync_port_mappings, for a router that has already been looked up.'''
+        current = UPnp.get_port_mappings(router)
+        return UPnp.apply_router_port_mappings(router, UPnp.diff_port_mappings(current, changes, prune))
+
+    @classmethod
+    def diff_port_mappings(cls, current, changes, prune=False):
+        '''
+        Computes the smallest list of changes that turns the current port mappings into the desired
+        ones. Mappings are matched on (remote host, public port, protocol); a wanted mapping that
+        already exists with the same destination and is enabled is left alone.
+        '''
+        current_by_key = {UPnp._port_mapping_key(p): p for p in current}
+        wanted_keys = set()
+        deleted_keys = set()
+        diff = []
+
+        for action, portmap in changes:
+            key = UPnp._port_mapping_key(portmap)
+            existing = current_by_key.get(key)
+
+            if action == 'delete':
+                if existing and key not in deleted_keys:
+                    diff.append(('delete', existing))
+                    deleted_keys.add(key)
+                continue
+
+            wanted_keys.add(key)
+            # A mapping the manifest deleted just before is added again as is
+            if existing and key not in deleted_keys:
+                if UPnp._port_mapping_target(existing) == UPnp._port_mapping_target(portmap) \
+                        and existing.is_enabled:
+                    continue
+                # The gateway refuses to repoint an existing mapping at another client
+                diff.append(('delete', existing))
+            diff.append(('add', portmap))
+
+        if prune:
+            for key, existing in current_by_key.items():
+                if key not in wanted_keys and key not in deleted_keys:
+                    diff.append(('delete', existing))
+
+        return diff
+
+    @classmethod
+    def _port_mapping_key(cls, portmap):
+        return (portmap.remote_host, portmap.public_port, portmap.protocol)
+
+    @classmethod
+    def _port_mapping_target(cls, portmap):
+        return (portmap.private_ip, portmap.private_port)
+
+    @classmethod
+    def apply_router_port_mappings(cls, router, changes):
+        '''Like apply_port_mappings, for a router that has already been looked up.'''
+        actions = {
+            'add': UPnp._add_port_mapping,
+            'delete': UPnp._delete_port_mapping
+        }
+
+        def apply(change):
+            action, portmap = change
+            try:
+                response = actions[action](router, portmap)
+            except requests.RequestException as e:
+                return PortMappingResult(action, portmap, str(e))
+            return PortMappingResult(action, portmap, *UPnp._get_soap_error(response))
+
+        for action, _ in changes:
+            if action not in actions:
+                raise ValueError('Unknown port mapping action "%s"' % action)
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=UPnp.batch_concurrency) as executor:
+            for action in ('delete', 'add'):
+                batch = [(i, c) for i, c in enumerate(changes) if c[0] == action]
+                for (i, _), result in zip(batch, executor.map(apply, [c for _, c in batch])):
+                    results[i] = result
+
+        return [results[i] for i in range(len(changes))]
+
+    @classmethod
+    def _added_port_mapping(cls, portmap):
+        '''The mapping as the router holds it after AddPortMapping.'''
+        arguments = UPnp._add_port_mapping_arguments(portmap)
+        return PortMapping(
+            remote_host=portmap.remote_host,
+            public_port=portmap.public_port,
+            protocol=portmap.protocol,
+            private_ip=portmap.private_ip,
+            private_port=portmap.private_port,
+            is_enabled=True,
+            description=arguments['NewPortMappingDescription'],
+            lease_duration=arguments['NewLeaseDuration']
+        )
+
+    @classmethod
+    def _add_port_mapping(cls, router, portmap):
+        '''Sends AddPortMapping, and records the outcome in the router's index.'''
+        index = UPnp.get_port_mapping_index(router)
+        try:
+            response = UPnp._soap_request(router, 'AddPortMapping', UPnp._add_port_mapping_arguments(portmap))
+        except requests.RequestException:
+            index.forget(portmap.public_port, portmap.protocol)
+            raise
+
+        # Whatever is mapped after a failure isn't known, e.g. after a conflict with another host's mapping
+        if response.status_code == 200:
+            index.add(UPnp._added_port_mapping(portmap))
+        else:
+            index.forget(portmap.public_port, portmap.protocol)
+        return response
+
+    @classmethod
+    def _add_port_mapping_arguments(cls, portmap):
+        return {
+            'NewRemoteHost': '' if portmap.remote_host == '*' else portmap.remote_host,
+            'NewExternalPort': portmap.public_port,
+            'NewProtocol': portmap.protocol,
+            'NewInternalPort': portmap.private_port,
+            'NewInternalClient': portmap.private_ip,
+            'NewEnabled': True,
+            'NewPortMappingDescription': portmap.description
+                or 'dave_upnp_{}:{}'.format(portmap.private_ip, portmap.private_port),
+            'NewLeaseDuration': max(portmap.lease_duration, 0)
+        }
+
+    @classmethod
+    def _delete_port_mapping(cls, router, portmap):
+        '''Sends DeletePortMapping, and records the outcome in the router's index.'''
+        index = UPnp.get_port_mapping_index(router)
+        try:
+            response = UPnp._soap_request(router, 'DeletePortMapping', UPnp._port_mapping_key_arguments(portmap))
+        except requests.RequestException:
+            index.forget(portmap.public_port, portmap.protocol)
+            raise
+
+        if response.status_code == 200:
+            index.remove(portmap.public_port, portmap.protocol)
+        else:
+            index.forget(portmap.public_port, portmap.protocol)
+        return response
+
+    @classmethod
+    def _port_mapping_key_arguments(cls, portmap):
+        return {
+            'NewRemoteHost': '' if portmap.remote_host == '*' else portmap.remote_host,
+            'NewExternalPort': portmap.public_port,
+            'NewProtocol': portmap.protocol
+        }
+
+    @classmethod
+    def add_any_port_mapping(cls, router, portmap):
+        '''
+        Adds a port mapping with AddAnyPortMapping, letting the router pick another public port if
+        the wanted one is taken. Only WANIPConnection:2 routers support this.
+        Returns:
+            int: The public port the router mapped.
+        Raises:
+            SOAPFault: If the router refused.
+        '''
+        index = UPnp.get_port_mapping_index(router)
+        try:
+            arguments = UPnp._soap_call(router, 'AddAnyPortMapping', UPnp._add_port_mapping_arguments(portmap))
+        except (SOAPFault, requests.RequestException, ElementTree.ParseError):
+            index.forget(portmap.public_port, portmap.protocol)
+            raise
+
+        public_port = _parse_int(arguments.get('NewReservedPort', ''), portmap.public_port)
+        added = UPnp._added_port_mapping(portmap)
+        added.public_port = public_port
+        index.add(added)
+        return public_port
+
+    @classmethod
+    def get_specific_port_mapping(cls, router, public_port, protocol, remote_host='*'):
+        '''
+        Looks up a single port mapping with GetSpecificPortMappingEntry.
+        Returns:
+            PortMapping: The mapping, or None if the router has no such mapping.
+        Raises:
+            SOAPFault: If the router failed the lookup for another reason.
+        '''
+        portmap = PortMapping(remote_host=remote_host, public_port=public_port, protocol=protocol)
+        try:
+            arguments = UPnp._soap_call(router, 'GetSpecificPortMappingEntry', UPnp._port_mapping_key_arguments(portmap))
+        except SOAPFault as fault:
+            # NoSuchEntryInArray
+            if fault.code == 714:
+                return None
+            raise
+
+        # The response only holds the mapping's other fields
+        found = PortMapping._from_arguments(arguments.items())
+        found.remote_host = portmap.remote_host
+        found.public_port = portmap.public_port
+        found.protocol = portmap.protocol
+        return found
+
+    @classmethod
+    def get_external_ip_address(cls, router):
+        '''Returns the router's public IP address as it reports it, which is empty while it is offline.'''
+        return UPnp._soap_call(router, 'GetExternalIPAddress', {}).get('NewExternalIPAddress', '').strip()
+
+    @classmethod
+    def list_port_mappings(cls, router_uuid, format='table'):
+        '''Lists the port mappings for a router, printing each as soon as it is fetched'''
+
+        router = UPnp._find_router(router_uuid)
+
+        if not router:
+            # Keep errors out of machine readable output
+            print('No router found with uuid "%s"' % router_uuid, file=sys.stdout if format == 'table' else sys.stderr)
             return
 
+        if format == 'table':
+            UPnp.print_port_mappings(UPnp.iter_port_mappings(router))
+        else:
+            UPnp.write_port_mappings(UPnp.iter_port_mappings(router), UPnp.port_mapping_writer(format))
+
+    @classmethod
+    def port_mapping_writer(cls, format, with_router=False, out=None):
+        '''
+        Returns a RowWriter for write_port_mappings, writing the CSV header straight away.
+        Args:
+            with_router (bool): Adds a router column with its UUID, for listings spanning several routers.
+        '''
+        fields = (['router'] if with_router else []) + list(PortMapping.__slots__)
+        return RowWriter(format, fields, out)
+
+    @classmethod
+    def write_port_mappings(cls, portmaps, writer, router=None):
+        '''
+        Writes port mappings with a writer from port_mapping_writer, each as soon as portmaps yields
+        it. One writer can be shared by the listings of several routers, given as router.
+        '''
+        for portmap in portmaps:
+            row = portmap.to_dict()
+            if router is not None:
+                row['router'] = router.uuid
+            writer.write(row)
+
+    @classmethod
+    def print_port_mappings(cls, portmaps):
+        '''Prints port mappings as a table, each row as soon as portmaps yields it'''
+        template = "{0:25}{1:30}{2:30}{3:10}{4:10}{5:20}"
+        count = 0
+        for portmap in portmaps:
+            if count == 0:
+                print(template.format("DESC", "PUBLIC", "PRIVATE", "PROTOCOL", "ENABLED", "LEASE DURATION"))
+            count += 1
+            # print(portmap)
+            print(
+                template.format(
+                    portmap.description,
+                    '{}:{}'.format(portmap.remote_host, portmap.public_port),
+                    '{}:{}'.format(portmap.private_ip, portmap.private_port),
+                    portmap.protocol,
+                    'Yes' if portmap.is_enabled else 'No',
+                    portmap.lease_duration
+                ),
+                flush=True
+            )
+
+        if count == 0:
+            print("No portmaps found!")
+
+    @classmethod
+    def get_port_mappings(cls, router):
+        '''Returns all of the port mappings on a router'''
+        listing = {}
+        portmaps = list(UPnp._iter_port_mappings(router, listing))
+        if listing.get('complete'):
+            UPnp.get_port_mapping_index(router).replace_all(portmaps)
+        return portmaps
+
+    @classmethod
+    def iter_port_mappings(cls, router):
+        '''
+        Yields the port mappings on a router one at a time, as each is fetched. Unlike
+        get_port_mappings the table is never held in memory, nor used to fill the router's index.
+        '''
+        return UPnp._iter_port_mappings(router, {})
+
+    @classmethod
+    def _iter_port_mappings(cls, router, listing):
+        '''Yields the port mappings on a router, setting listing['complete'] once the whole table has been read.'''
+        # WANIPConnection:2 can return the whole table in one call, fall back to walking it by index
+        # if the gateway refuses.
+        if router.type == UPnp._wanip2_service_type:
+            count = 0
+            for portmap in UPnp._iter_port_mapping_list(router, listing):
+                count += 1
+                yield portmap
+            if listing.get('complete'):
+                return
+            if count > 0:
+                # The entries already handed out can't be taken back, don't list them twice
+                print('Stopped listing port mappings after %d entries: GetListOfPortMappings failed' % count, file=sys.stderr)
+                return
+
+        yield from UPnp._iter_generic_port_mappings(router, listing)
+
+    @classmethod
+    def get_port_mapping_index(cls, router):
+        '''Returns the PortMappingIndex of a router, shared by everything acting on it in this process.'''
+        key = router.uuid or router.base_url
+        with UPnp._indexes_lock:
+            index = UPnp._indexes.get(key)
+            if index is None:
+                index = UPnp._indexes[key] = PortMappingIndex(UPnp.index_max_age_secs)
+            return index
+
+    @classmethod
+    def find_port_mapping(cls, router, public_port, protocol, refresh=False):
+        '''
+        Looks up the mapping of one public port, from the index if it knows it and otherwise with a
+        single GetSpecificPortMappingEntry call, however large the router's table is.
+        Args:
+            refresh (bool): Always ask the router.
+        Returns:
+            PortMapping: The mapping, or None if the port is not mapped.
+        Raises:
+            SOAPFault: If the router failed the lookup.
+        '''
+        index = UPnp.get_port_mapping_index(router)
+        if not refresh:
+            known, portmap = index.lookup(public_port, protocol)
+            if known:
+                return portmap
+
+        portmap = UPnp.get_specific_port_mapping(router, public_port, protocol)
+        if portmap is not None:
+            index.add(portmap)
+        else:
+            index.remove(public_port, protocol)
+        return portmap
+
+    @classmethod
+    def find_port_mappings_for_host(cls, router, private_ip):
+        '''Returns the mappings pointing at a host, listing the router's table only if the index is out of date.'''
+        index = UPnp.get_port_mapping_index(router)
+        if not index.complete:
+            UPnp.get_port_mappings(router)
+        return index.for_private_ip(private_ip)
+
+    @classmethod
+    def check_port_mapping_conflict(cls, router, portmap):
+        '''Returns the existing mapping of portmap's public port if it points somewhere else, otherwise None.'''
+        existing = UPnp.find_port_mapping(router, portmap.public_port, portmap.protocol)
+        if existing is not None and UPnp._port_mapping_target(existing) != UPnp._port_mapping_target(portmap):
+            return existing
+        return None
+
+    @classmethod
+    def get_port_mapping_table(cls, router):
+        '''Returns all of the port mappings on a router as a column-oriented PortMappingTable'''
+        return PortMappingTable.from_port_mappings(UPnp.get_port_mappings(router))
+
+    @classmethod
+    def _iter_port_mapping_list(cls, router, listing):
+        '''
+        Yields the whole port mapping table fetched with GetListOfPortMappings, as it downloads.
+        listing['complete'] is only set if both protocols were listed, otherwise the gateway
+        refused or failed the listing part way through.
+        '''
+        for protocol in ('TCP', 'UDP'):
+            arguments = {
+                'NewStartPort': 0,
+                'NewEndPort': 65535,
+                'NewProtocol': protocol,
+                'NewManage': True,
+                'NewNumberOfPorts': 0
+            }
+
+            # The listing is parsed as it downloads, so large tables are never held as one document
+            parser = SOAPResponseParser(router.type, 'GetListOfPortMappings', stream_argument='NewPortListing')
+            try:
+                with UPnp._soap_request(router, 'GetListOfPortMappings', arguments, stream=True) as response:
+                    with Metrics.timer('soap_list_stream'):
+                        for chunk in response.iter_content(chunk_size=UPnp.stream_chunk_size):
+                            Metrics.count('soap_bytes_received', len(chunk))
+                            parser.feed(chunk)
+                            for element in parser.read_entries():
+                                yield PortMapping._from_xml_properties(element)
+                arguments = parser.close()
+            except SOAPFault as fault:
+                Metrics.count('soap_faults', code=fault.code)
+                # PortMappingNotFound, there are no mappings for this protocol
+                if fault.code == 730:
+                    continue
+                return
+            except (requests.RequestException, ElementTree.ParseError):
+                return
+
+            if arguments is None:
+                return
+            for element in parser.read_entries():
+                yield PortMapping._from_xml_properties(element)
+
+        listing['complete'] = True
+
+    @classmethod
+    def _iter_generic_port_mappings(cls, router, listing):
+        '''
+        Walks the port mapping table with GetGenericPortMappingEntry, keeping a window of index
+        requests in flight until the gateway reports the end of the table, and yielding each entry
+        in order as it arrives. listing['complete'] is set if the end of the table was reached.
+        '''
+        def fetch(index):
+            return UPnp._soap_request(router, 'GetGenericPortMappingEntry', {'NewPortMappingIndex': index})
+
+        count = 0
+
+        with ThreadPoolExecutor(max_workers=UPnp.enumeration_window) as executor:
+            in_flight = deque(executor.submit(fetch, i) for i in range(UPnp.enumeration_window))
+            next_index = UPnp.enumeration_window
+
+            try:
+                while in_flight:
+                    try:
+                        response = in_flight.popleft().result()
+                        with Metrics.timer('soap_parse'):
+                            arguments, _ = parse_response(response.content, router.type, 'GetGenericPortMappingEntry')
+                    except SOAPFault as fault:
+                        Metrics.count('soap_faults', code=fault.code)
+                        # SpecifiedArrayIndexInvalid marks the end of the table, anything else is an error
+                        if fault.code != 713:
+                            print('Stopped listing port mappings after %d entries: %s' % (count, fault), file=sys.stderr)
+                        else:
+                            listing['complete'] = True
+                        break
+                    except (requests.RequestException, ElementTree.ParseError) as e:
+                        print('Stopped listing port mappings after %d entries: %s' % (count, e), file=sys.stderr)
+                        break
+
+                    if arguments is None:
+                        print('Stopped listing port mappings after %d entries: unexpected response' % count, file=sys.stderr)
+                        break
+
+                    in_flight.append(executor.submit(fetch, next_index))
+                    next_index += 1
+                    count += 1
+                    yield PortMapping._from_arguments(arguments.items())
+            finally:
+                # Also reached when the caller stops reading early
+                for future in in_flight:
+                    future.cancel()
+
+    @classmethod
+    def _soap_call(cls, router, action, arguments):
+        '''
+        Calls a SOAP action and returns its output arguments.
+        Raises:
+            SOAPFault: If the router answered with a fault.
+            requests.RequestException, ElementTree.ParseError: If the call or the response failed.
+        '''
+        response = UPnp._soap_request(router, action, arguments)
+        try:
+            outputs, _ = parse_response(response.content, router.type, action)
+        except SOAPFault as fault:
+            Metrics.count('soap_faults', code=fault.code)
+            raise
+
+        if outputs is None:
+            raise ElementTree.ParseError('No %s response from the router (HTTP status %d)' % (action, response.status_code))
+        return outputs
+
+    @classmethod
+    def _soap_request(cls, router, action, arguments, stream=False):
+        '''Posts a SOAP action with the given arguments to a router through its pooled session.'''
         url = '{}{}'.format(router.base_url, router.control_url)
+        data = build_request(router.type, action, arguments)
 
         headers = {
             'Host': '{}:{}'.format(router.ip, router.port),
             'Content-Type': 'text/xml; charset=utf-8',
-            'SOAPACTION': '{}#GetGenericPortMappingEntry'.format(router.type)
+            'SOAPACTION': '{}#{}'.format(router.type, action)
         }
 
-        index = -1
-        portmap_found = True
-        portmaps = []
-        
-        while portmap_found:
-            index += 1
-            data = UPnp._list_port_mappings_template.format(index)
-            response = requests.post(url, data=data, headers=headers)
-            portmap = PortMapping.parse_port_map_xml(response.text, router.type)
-            if not portmap:
-                portmap_found = False
-            else:
-                portmaps.append(portmap)
-            
-        if len(portmaps) > 0:
-            template = "{0:25}{1:30}{2:30}{3:10}{4:10}{5:20}"
-            print(template.format("DESC", "PUBLIC", "PRIVATE", "PROTOCOL", "ENABLED", "LEASE DURATION"))
-            for portmap in portmaps:
-                # print(portmap)
-                print(
-                    template.format(
-                        portmap.description,
-                        '{}:{}'.format(portmap.remote_host, portmap.public_port),
-                        '{}:{}'.format(portmap.private_ip, portmap.private_port),
-                        portmap.protocol,
-                        'Yes' if portmap.is_enabled else 'No',
-                        portmap.lease_duration
-                    )
-                )
-        else:
-            print("No portmaps found!")
+        start = time.perf_counter()
+        response = SessionPool.get(router.base_url).post(
+            url,
+            data=data,
+            headers=headers,
+            stream=stream,
+            idempotent=action in UPnp.idempotent_actions,
+            transient=UPnp._is_transient_response
+        )
+
+        # For streamed responses this is the time until the headers arrived
+        Metrics.observe('soap_seconds', time.perf_counter() - start, router=router.uuid or router.ip, action=action)
+        Metrics.count('soap_calls', action=action)
+        Metrics.count('soap_bytes_sent', len(data))
+        if not stream:
+            Metrics.count('soap_bytes_received', len(response.content))
+        return response
 
     @classmethod
-    def _find_router(cls, router_uuid):
-        routers = SSDP.list()
+    def _is_transient_response(cls, response):
+        '''Whether an error response is worth retrying: ActionFailed, or a server error that isn't a SOAP fault.'''
+        fault = parse_fault(response.content)
+        if fault is None:
+            return True
+        return fault.code in UPnp._transient_fault_codes
 
-        _default_router = None
-        router = next(
-            (r for r in routers if r.uuid == router_uuid),
-            _default_router
-        )
+    @classmethod
+    def _get_soap_error(cls, response):
+        '''
+        Returns a description of why a SOAP action failed and its UPnP error code, None if it
+        failed without a SOAP fault, or (None, None) if it succeeded.
+        '''
+        if response.status_code == 200:
+            return (None, None)
+
+        fault = parse_fault(response.content)
+        if fault is not None:
+            Metrics.count('soap_faults', code=fault.code)
+            return (str(fault), fault.code)
+
+        return ('HTTP status %d' % response.status_code, None)
 
-        return router
\ No newline at end of file
+    @classmethod
+    def _find_router(cls, router_uuid):
+        # Looks the router up in the cache by UUID, only searching the network if it isn't there
+        return SSDP.find(router_uuid)
\ No newline at end of file